@@ -0,0 +1,132 @@
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+
+import encoder
+
+RESULTS_FILE = "results.jsonl"
+
+
+def read_requests(path):
+    """Yields one request dict per non-empty JSONL line, without reading ahead.
+
+    Records need a "prompt"; "id" defaults to the line number.
+    """
+    with open(path) as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            record.setdefault("id", str(line_no))
+            yield record
+
+
+def output_path(out_dir, record, extension=".png"):
+    name = re.sub(r"[^A-Za-z0-9._-]", "_", str(record["id"]))
+    return os.path.join(out_dir, name + extension)
+
+
+def submit(generator, record):
+    return generator.submit(
+        record["prompt"],
+        record.get("guidance_scale", 7.0),
+        record.get("height"),
+        record.get("width"),
+        negative_prompt=record.get("negative_prompt", ""),
+        num_inference_steps=record.get("steps"),
+        seed=record.get("seed"),
+        model_id=record.get("model"),
+    )
+
+
+def failed(record, error, **fields):
+    """Result line of a request that failed with error."""
+    return dict({"id": record.get("id"), "prompt": record.get("prompt"),
+                 "status": "failed", "error": str(error)}, **fields)
+
+
+def save_result(writer, future, record, path, sink, **fields):
+    """Writes the image of a finished generation to path, then calls sink
+    with the request's result line.
+
+    fields are added to the result line, e.g. the device that generated it.
+    A failed generation is reported right away.
+    """
+    error = future.exception()
+    if error is not None:
+        sink(failed(record, error, **fields))
+        return
+    result = dict({"id": record["id"], "prompt": record["prompt"]}, **fields)
+    image = future.result()
+    result.update(seed=image.info.get("seed"),
+                  cache_hit=image.info.get("cache_hit", False))
+
+    def written(f):
+        error = f.exception()
+        if error is None:
+            result.update(status="done", path=f.result())
+        else:
+            result.update(status="failed", error=str(error))
+        sink(result)
+
+    writer.submit(image, path).add_done_callback(written)
+
+
+def run(generator, input_path, out_dir, window=64, format="png",
+        quality=90):
+    """Generates every request in input_path into out_dir.
+
+    At most window requests are in flight, which is what lets the generator
+    batch compatible ones while keeping memory flat for any input size.
+    Images are encoded and written off the main thread; a result line is
+    appended once an image is on disk. Requests whose image already exists
+    are skipped, so an interrupted run can simply be started again.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    writer = encoder.ImageWriter(out_dir, format=format, quality=quality)
+    counts = {"done": 0, "failed": 0, "skipped": 0}
+    lock = threading.Lock()
+    start_time = time.time()
+
+    with open(os.path.join(out_dir, RESULTS_FILE), "a") as results:
+        pending = {}
+
+        def record_result(result):
+            with lock:
+                counts[result["status"]] += 1
+                results.write(json.dumps(result) + "\n")
+                results.flush()
+
+        def finish(futures):
+            for future in futures:
+                record, path = pending.pop(future)
+                save_result(writer, future, record, path, record_result)
+
+        for record in read_requests(input_path):
+            path = output_path(out_dir, record, writer.extension)
+            if os.path.exists(path):
+                counts["skipped"] += 1
+                continue
+            try:
+                future = submit(generator, record)
+            except Exception as e:
+                # e.g. a record without a prompt
+                record_result(failed(record, e))
+                continue
+            pending[future] = (record, path)
+            while len(pending) >= window:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                finish(done)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            finish(done)
+        writer.close()
+
+    print("--- batch: {done} done, {failed} failed, {skipped} skipped "
+          "in %s seconds ---".format(**counts) % (time.time() - start_time))
+    return counts
@@ -0,0 +1,155 @@
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import CancelledError, Future, InvalidStateError
+
+import metrics
+
+# One prompt waiting to be generated. progress, if set, is called as
+# progress(step, total_steps, eta_seconds, latents) after every step;
+# latents may be None for generators that don't have any. cancel is an
+# optional CancelToken.
+Request = namedtuple("Request", "prompt negative_prompt seed progress cancel",
+                     defaults=(None, None))
+
+
+class CancelToken:
+    """Set once by whoever gave up on a request, polled by whoever runs it."""
+
+    def __init__(self):
+        self.cancelled = False
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def cancel(self):
+        with self.lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def add_callback(self, callback):
+        with self.lock:
+            if not self.cancelled:
+                self.callbacks.append(callback)
+                return
+        callback()
+
+
+def cancel_future(future):
+    # A queued item is simply dropped. A running one is failed right away so
+    # its caller is released, while the batch it belongs to winds down.
+    if future.cancel():
+        return
+    try:
+        future.set_exception(CancelledError())
+    except InvalidStateError:
+        pass
+
+
+class MicroBatcher:
+    """Coalesces items submitted within max_wait seconds into one call.
+
+    Items are grouped by key; only items with the same key are run
+    together. run_batch(key, items) must return one result per item; an
+    exception instance in place of a result fails just that item.
+    """
+
+    def __init__(self, run_batch, max_batch_size=4, max_wait=0.01):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pending = []
+        self.running = 0
+        self.closed = False
+        self.idle_callbacks = []
+        self.cond = threading.Condition()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, key, item, cancel=None):
+        future = Future()
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("batcher is closed")
+            self.pending.append((key, item, future, time.monotonic()))
+            self.cond.notify()
+        if cancel is not None:
+            cancel.add_callback(lambda: cancel_future(future))
+        return future
+
+    def busy(self):
+        with self.cond:
+            return bool(self.pending) or self.running > 0
+
+    def add_idle_callback(self, callback):
+        """Calls callback, without arguments, whenever the batcher runs out
+        of work."""
+        self.idle_callbacks.append(callback)
+
+    def close(self):
+        """Stops accepting items and waits for pending ones to finish."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.worker.join()
+
+    def _take_batch(self):
+        with self.cond:
+            while not self.pending:
+                if self.closed:
+                    return None, None
+                self.cond.wait()
+            key, _, _, arrived = self.pending[0]
+            deadline = arrived + self.max_wait
+            while True:
+                same = [p for p in self.pending if p[0] == key]
+                remaining = deadline - time.monotonic()
+                if (len(same) >= self.max_batch_size or remaining <= 0
+                        or self.closed):
+                    break
+                self.cond.wait(remaining)
+            batch = same[:self.max_batch_size]
+            taken = set(id(p) for p in batch)
+            self.pending = [p for p in self.pending if id(p) not in taken]
+            self.running += 1
+        return key, batch
+
+    def _run(self):
+        while True:
+            key, batch = self._take_batch()
+            if batch is None:
+                return
+            try:
+                self._run_one(key, batch)
+            finally:
+                with self.cond:
+                    self.running -= 1
+                    idle = not self.pending and self.running == 0
+                # Outside the lock, so callbacks may call busy().
+                if idle:
+                    for callback in self.idle_callbacks:
+                        callback()
+
+    def _run_one(self, key, batch):
+        batch = [p for p in batch if p[2].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        now = time.monotonic()
+        for p in batch:
+            metrics.observe("batch_wait", now - p[3])
+        try:
+            results = self.run_batch(key, [p[1] for p in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        for p, result in zip(batch, results):
+            # Futures cancelled while running were already resolved.
+            try:
+                if isinstance(result, BaseException):
+                    p[2].set_exception(result)
+                else:
+                    p[2].set_result(result)
+            except InvalidStateError:
+                pass
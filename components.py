@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+import struct
+import threading
+import weakref
+
+# Pipeline components that are commonly byte-identical across fine-tunes of
+# one base model. The UNet is what fine-tunes change, so it is never shared.
+SHAREABLE = ("vae", "text_encoder", "tokenizer", "safety_checker",
+             "feature_extractor")
+
+CHUNK_SIZE = 16 << 20
+
+# Config keys that record where and with which library version a component
+# was saved rather than what it is. They differ between fine-tunes even
+# when the weights don't.
+METADATA_KEYS = ("_name_or_path", "name_or_path", "_commit_hash",
+                 "_diffusers_version", "transformers_version",
+                 "_use_default_values")
+
+# (realpath, size, mtime_ns) -> hex digest
+_digests = {}
+_digests_lock = threading.Lock()
+
+
+def _hash_range(f, start, length, h):
+    f.seek(start)
+    while length > 0:
+        chunk = f.read(min(CHUNK_SIZE, length))
+        if not chunk:
+            break
+        h.update(chunk)
+        length -= len(chunk)
+
+
+def safetensors_digest(path):
+    """Digest of the tensors in a safetensors file.
+
+    Each tensor contributes its name, dtype, shape and a hash of its bytes.
+    The free-form __metadata__ entry is ignored, so two files holding the
+    same weights match even if they were written by different tools.
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        (header_len,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_len))
+        header.pop("__metadata__", None)
+        data_start = 8 + header_len
+        for name in sorted(header):
+            info = header[name]
+            start, end = info["data_offsets"]
+            h.update(json.dumps([name, info["dtype"], info["shape"]]).encode())
+            tensor = hashlib.sha256()
+            _hash_range(f, data_start + start, end - start, tensor)
+            h.update(tensor.digest())
+    return h.hexdigest()
+
+
+def config_digest(path):
+    """Digest of a JSON config without its METADATA_KEYS."""
+    with open(path) as f:
+        config = json.load(f)
+    if isinstance(config, dict):
+        for key in METADATA_KEYS:
+            config.pop(key, None)
+    return hashlib.sha256(
+        json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+
+def file_digest(path):
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime_ns)
+    with _digests_lock:
+        if key in _digests:
+            return _digests[key]
+    if path.endswith(".safetensors"):
+        digest = safetensors_digest(path)
+    elif path.endswith(".json"):
+        digest = config_digest(path)
+    else:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            _hash_range(f, 0, st.st_size, h)
+        digest = h.hexdigest()
+    with _digests_lock:
+        _digests[key] = digest
+    return digest
+
+
+def folder_fingerprint(folder, extra=""):
+    h = hashlib.sha256(extra.encode())
+    for name in sorted(os.listdir(folder)):
+        path = os.path.join(folder, name)
+        if os.path.isfile(path):
+            h.update(name.encode())
+            h.update(file_digest(path).encode())
+    return h.hexdigest()
+
+
+class ComponentPool:
+    """Hands out already-resident pipeline components with identical weights.
+
+    Modules are held weakly, so a component disappears from the pool once
+    the last pipeline using it is gone.
+    """
+
+    def __init__(self):
+        self.modules = weakref.WeakValueDictionary()
+        # id(module) -> pipelines currently using it
+        self.owners = {}
+        self.lock = threading.Lock()
+
+    def fingerprints(self, pipeline_dir, dtype):
+        result = {}
+        for name in SHAREABLE:
+            folder = os.path.join(pipeline_dir, name)
+            if os.path.isdir(folder):
+                result[name] = folder_fingerprint(folder, str(dtype))
+        return result
+
+    def lookup(self, fingerprints):
+        with self.lock:
+            found = {}
+            for name, fp in fingerprints.items():
+                module = self.modules.get(fp)
+                if module is not None:
+                    found[name] = module
+            return found
+
+    def register(self, owner, fingerprints, components):
+        with self.lock:
+            for name, fp in fingerprints.items():
+                module = components.get(name)
+                if module is None:
+                    continue
+                self.modules.setdefault(fp, module)
+                owners = self.owners.setdefault(id(module), weakref.WeakSet())
+                owners.add(owner)
+
+    def release(self, owner):
+        with self.lock:
+            for module_id in list(self.owners):
+                self.owners[module_id].discard(owner)
+                if not self.owners[module_id]:
+                    del self.owners[module_id]
+
+    def users(self, module):
+        with self.lock:
+            return list(self.owners.get(id(module), ()))
+
+
+pool = ComponentPool()
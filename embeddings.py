@@ -0,0 +1,69 @@
+import threading
+from collections import OrderedDict
+
+
+def normalize(prompt):
+    return " ".join(prompt.split())
+
+
+def tensor_bytes(tensors):
+    return sum(t.numel() * t.element_size() for t in tensors if t is not None)
+
+
+class EmbeddingCache:
+    """LRU cache of text-encoder outputs.
+
+    Keys are (model_id, encoder, normalized prompt); values are the tuple of
+    tensors the encoder produced, which callers should keep in CPU memory so
+    the cache doesn't hold on to accelerator memory. Eviction keeps both the
+    entry count and the total tensor bytes under their limits.
+    """
+
+    def __init__(self, max_entries=4096, max_bytes=1 << 30):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_or_compute(self, model_id, encoder, prompt, compute):
+        key = (model_id, encoder, normalize(prompt))
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+
+        value = tuple(compute(key[2]))
+        size = tensor_bytes(value)
+        with self.lock:
+            if key not in self.entries and size <= self.max_bytes:
+                self.entries[key] = value
+                self.bytes += size
+                while (len(self.entries) > self.max_entries
+                       or self.bytes > self.max_bytes):
+                    _, old = self.entries.popitem(last=False)
+                    self.bytes -= tensor_bytes(old)
+        return value
+
+    def drop(self, model_id):
+        """Evicts every entry of model_id, e.g. once it is unloaded."""
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == model_id]:
+                self.bytes -= tensor_bytes(self.entries.pop(key))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+            }
+
+
+cache = EmbeddingCache()
@@ -0,0 +1,80 @@
+import hashlib
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+# format name -> (PIL format, file extension)
+FORMATS = {
+    "png": ("PNG", ".png"),
+    "webp": ("WEBP", ".webp"),
+    "jpeg": ("JPEG", ".jpg"),
+}
+
+
+class ImageWriter:
+    """Encodes and writes images on a small thread pool.
+
+    submit() returns a future for the written path and only blocks once
+    max_pending images are waiting, so the generation thread can start its
+    next batch while earlier images are still being compressed. Without an
+    explicit path, images are stored under the hash of their encoded bytes,
+    which keeps concurrent requests from overwriting each other.
+    """
+
+    def __init__(self, out_dir, format="png", quality=90, compress_level=6,
+                 max_workers=2, max_pending=16):
+        if format not in FORMATS:
+            raise ValueError("unsupported image format: {}".format(format))
+        self.out_dir = out_dir
+        self.format = format
+        self.quality = quality
+        self.compress_level = compress_level
+        self.extension = FORMATS[format][1]
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, image, path=None):
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(self._write, image, path)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self.slots.release())
+        return future
+
+    def encode(self, image):
+        pil_format = FORMATS[self.format][0]
+        if pil_format == "PNG":
+            options = {"compress_level": self.compress_level}
+        else:
+            options = {"quality": self.quality}
+        if pil_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        buf = io.BytesIO()
+        image.save(buf, format=pil_format, **options)
+        return buf.getvalue()
+
+    def _write(self, image, path):
+        with metrics.timer("image_encode", format=self.format):
+            data = self.encode(image)
+        if path is None:
+            name = hashlib.sha256(data).hexdigest()[:32] + self.extension
+            path = os.path.join(self.out_dir, name)
+            if os.path.exists(path):
+                return path
+        with metrics.timer("disk_write"):
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            # Written under a temporary name first so a crash never leaves a
+            # truncated file behind.
+            tmp = "{}.{}.tmp".format(path, threading.get_ident())
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return path
+
+    def close(self):
+        self.executor.shutdown(wait=True)
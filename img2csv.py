@@ -1,55 +1,395 @@
 from PIL import Image
 import numpy as np
+import argparse
+import hashlib
+import io
+import itertools
+import json
+import struct
 import sys
 import os
 import csv
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
-OUTPUT_CSV="output.csv"
+OUTPUT_NPY="output.npy"
 LABEL='andy'
+# Fixed-size .npy header, so the shape can be rewritten in place.
+HEADER_BYTES = 128
+
+
 # default format can be changed as needed
-def createFileList(myDir, format='.png'):
-    fileList = []
-    print(myDir)
-    labels = []
-    names = []
+def scan(myDir, format='.png'):
+    """Yields image paths under myDir in a stable order, without listing
+    the whole tree first."""
     for root, dirs, files in os.walk(myDir, topdown=True):
-            for name in files:
-                if name.endswith(format):
-                    fullName = os.path.join(root, name)
-                    fileList.append(fullName)
-                    labels.append(LABEL)
-                    names.append(name)
-    return fileList, labels, names
-
-try:
-    os.remove(OUTPUT_CSV)
-except OSError:
-    pass
-
-# load the original image
-myFileList, labels, names  = createFileList('images')
-i = 0
-for file in myFileList:
-    print(file)
-    img_file = Image.open(file)
-    # img_file.show()
-# get original image parameters...
-    width, height = img_file.size
-    format = img_file.format
-    mode = img_file.mode
-# Make image Greyscale
-    # img_file = img_file.convert('L')
-    #img_grey.save('result.png')
-    #img_grey.show()
-# Save Greyscale values
-    data = img_file.getdata()
-    value = np.asarray(img_file.getdata(), dtype=np.int16).reshape((width, height,3))
-    value = value.flatten()
-    
-    value = np.append(value,labels[i])
-    i +=1
-    
-    # print(value)
-    with open(OUTPUT_CSV, 'a') as f:
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith(format):
+                yield os.path.join(root, name)
+
+
+def index_path(path):
+    return os.path.splitext(path)[0] + ".index.csv"
+
+
+def manifest_path(path):
+    return os.path.splitext(path)[0] + ".manifest.json"
+
+
+def file_hash(file):
+    digest = hashlib.sha256()
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_header(f, shape, dtype=np.uint8):
+    header = repr({"descr": np.dtype(dtype).str, "fortran_order": False,
+                   "shape": tuple(shape)})
+    magic = b"\x93NUMPY\x01\x00"
+    size = HEADER_BYTES - len(magic) - 2
+    if len(header) + 1 > size:
+        raise ValueError("shape {} doesn't fit the header".format(shape))
+    f.seek(0)
+    f.write(magic + struct.pack("<H", size) + header.ljust(size - 1).encode()
+            + b"\n")
+
+
+class NpySink:
+    """A (count, *shape) .npy file that rows are written into in place.
+
+    reserve() grows the file ahead of the rows being written, by any
+    process, through np.memmap; close() records the final row count in the
+    header. The result is a regular .npy file: np.load(path, mmap_mode="r")
+    reads it without copying. With count, an existing file is reopened to
+    append after its first count rows.
+    """
+
+    def __init__(self, path, shape, dtype=np.uint8, count=0):
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.row_bytes = int(np.prod(shape)) * self.dtype.itemsize
+        self.count = count
+        self.file = open(path, "rb+" if count else "wb+")
+        # Rows past count were written by a run that never finished.
+        self.file.truncate(HEADER_BYTES + count * self.row_bytes)
+        write_header(self.file, (count,) + self.shape, self.dtype)
+
+    def reserve(self, count):
+        if count > self.count:
+            self.count = count
+            self.file.truncate(HEADER_BYTES + count * self.row_bytes)
+
+    def close(self):
+        write_header(self.file, (self.count,) + self.shape, self.dtype)
+        self.file.close()
+
+
+def open_rows(path, shape, start, count, dtype=np.uint8, mode="r+"):
+    row_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return np.memmap(path, dtype=dtype, mode=mode,
+                     offset=HEADER_BYTES + start * row_bytes,
+                     shape=(count,) + tuple(shape))
+
+
+class Transform:
+    """Turns decoded images into fixed-shape rows.
+
+    Each image is converted to mode and resized to size (width, height) as
+    it is decoded; the batch is then stacked and cast to dtype in one go.
+    Float rows are scaled to [0, 1] and, given per-channel mean and std,
+    normalized. Rows are always (height, width, channels).
+    """
+
+    def __init__(self, size=None, mode=None, dtype="uint8", mean=None,
+                 std=None):
+        if (mean is None) != (std is None):
+            raise ValueError("mean and std go together")
+        if mean is not None and np.dtype(dtype).kind != "f":
+            raise ValueError("normalization needs a float dtype")
+        self.size = tuple(size) if size else None
+        self.mode = mode
+        self.dtype = np.dtype(dtype)
+        self.mean = mean
+        self.std = std
+
+    @property
+    def config(self):
+        return {"size": self.size and list(self.size), "mode": self.mode,
+                "dtype": self.dtype.str, "mean": self.mean, "std": self.std}
+
+    def load(self, file):
+        with Image.open(file) as img_file:
+            if self.mode and img_file.mode != self.mode:
+                img_file = img_file.convert(self.mode)
+            if self.size and img_file.size != self.size:
+                img_file = img_file.resize(self.size, Image.BILINEAR)
+            value = np.asarray(img_file)
+        return value[..., None] if value.ndim == 2 else value
+
+    def apply(self, batch):
+        """Casts and normalizes a stacked (N, H, W, C) uint8 batch."""
+        if self.dtype == np.uint8:
+            return batch
+        batch = batch.astype(self.dtype)
+        if self.dtype.kind == "f":
+            batch /= 255
+            if self.mean is not None:
+                batch -= np.asarray(self.mean, dtype=self.dtype)
+                batch /= np.asarray(self.std, dtype=self.dtype)
+        return batch
+
+
+def write_rows(path, shape, start, files, transform):
+    """Decodes files into rows start.. of the dataset at path.
+
+    Runs in a worker process; only the file names cross the process
+    boundary, the pixels go straight into the memory-mapped output. Returns
+    the content hash of each file.
+    """
+    rows = open_rows(path, shape, start, len(files), transform.dtype)
+    hashes, values = [], []
+    for file in files:
+        with open(file, "rb") as f:
+            data = f.read()
+        hashes.append(hashlib.sha256(data).hexdigest())
+        value = transform.load(io.BytesIO(data))
+        if value.shape != tuple(shape):
+            raise ValueError("{} is {}, expected {}; set a size and mode to "
+                             "convert mixed images".format(
+                                 file, value.shape, tuple(shape)))
+        values.append(value)
+    rows[:] = transform.apply(np.stack(values))
+    rows.flush()
+    return hashes
+
+
+def make_labeler(label_from="constant", labels_file=None, input_dir="."):
+    """Returns a function from an image path to its label.
+
+    label_from is "constant" (LABEL for every image), "dir" (the name of the
+    image's directory) or "file": labels_file is a CSV of path,label rows,
+    with paths relative to input_dir or bare file names.
+    """
+    if label_from == "constant":
+        return lambda file: LABEL
+    if label_from == "dir":
+        return lambda file: os.path.basename(os.path.dirname(file))
+    if label_from != "file" or not labels_file:
+        raise ValueError("label_from must be constant, dir, or file with a "
+                         "labels_file")
+    with open(labels_file, newline="") as f:
+        mapping = dict(csv.reader(f))
+
+    def label(file):
+        for key in (os.path.relpath(file, input_dir), os.path.basename(file)):
+            if key in mapping:
+                return mapping[key]
+        raise ValueError("no label for {} in {}".format(file, labels_file))
+    return label
+
+
+def load_dataset(path):
+    """Returns (images, index) with images memory-mapped read-only.
+
+    index holds one (path, label) per row, or None for deleted rows.
+    """
+    with open(index_path(path), newline="") as f:
+        index = [None if row["deleted"] == "1" else (row["path"], row["label"])
+                 for row in csv.DictReader(f)]
+    return np.load(path, mmap_mode="r"), index
+
+
+def load_manifest(output):
+    """Returns the manifest of a previous run into output, or None.
+
+    The manifest maps each converted file to its size, mtime, content hash,
+    row and label; rows no file maps to are tombstones.
+    """
+    try:
+        with open(manifest_path(output)) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    if not os.path.exists(output):
+        return None
+    return manifest
+
+
+def save_manifest(output, manifest):
+    path = manifest_path(output)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+
+def write_index(output, manifest):
+    rows = [None] * manifest["count"]
+    for file, entry in manifest["files"].items():
+        rows[entry["row"]] = (file, entry["label"])
+    path = index_path(output)
+    with open(path + ".tmp", "w", newline="") as f:
+        index = csv.writer(f)
+        index.writerow(["row", "path", "label", "deleted"])
+        for row, entry in enumerate(rows):
+            if entry is None:
+                index.writerow([row, "", "", 1])
+            else:
+                index.writerow([row, entry[0], entry[1], 0])
+    os.replace(path + ".tmp", path)
+
+
+def export_csv(output, csv_path):
+    """Writes every live row as flattened pixel values, then the label."""
+    images, index = load_dataset(output)
+    with open(csv_path, "w", newline="") as f:
         writer = csv.writer(f)
-        writer.writerow(value)
\ No newline at end of file
+        for value, entry in zip(images, index):
+            if entry is not None:
+                writer.writerow(value.reshape(-1).tolist() + [entry[1]])
+
+
+def changes(input_dir, format, manifest):
+    """Yields (path, size, mtime) of files that are new or changed.
+
+    Deleted and changed files are dropped from manifest["files"], which
+    turns their rows into tombstones. A file whose size or mtime changed
+    but whose content didn't is only restamped.
+    """
+    files = manifest["files"]
+    seen = set()
+    for file in scan(input_dir, format):
+        seen.add(file)
+        st = os.stat(file)
+        entry = files.get(file)
+        if entry is not None:
+            if (entry["size"], entry["mtime"]) == (st.st_size, st.st_mtime):
+                continue
+            if entry["sha256"] == file_hash(file):
+                entry.update(size=st.st_size, mtime=st.st_mtime)
+                continue
+            del files[file]
+        yield file, st.st_size, st.st_mtime
+    for file in set(files) - seen:
+        del files[file]
+
+
+def convert(input_dir, output=OUTPUT_NPY, format='.png', csv_path=None,
+            workers=None, batch_size=64, rebuild=False, transform=None,
+            labeler=None):
+    """Converts every image under input_dir into one .npy dataset.
+
+    transform (a Transform) sets the shape and dtype of the rows and
+    labeler (see make_labeler) their labels.
+
+    Files are decoded by a pool of worker processes, batch_size at a time,
+    straight into their rows of the output, in directory scan order. At most
+    two batches per worker are in flight, so memory stays flat however big
+    the folder is. The file and label of each row go to a sidecar index.
+
+    A manifest next to the output records what was converted, so a rerun
+    only appends new and changed files and tombstones the rows of changed
+    and deleted ones; rebuild starts from scratch instead, as does a change
+    of transform. csv_path optionally also exports the old CSV layout.
+    """
+    transform = transform or Transform()
+    labeler = labeler or make_labeler()
+    manifest = None if rebuild else load_manifest(output)
+    if manifest is not None and manifest.get("transform") != transform.config:
+        print("transform changed, rebuilding {}".format(output))
+        manifest = None
+    if manifest is None:
+        manifest = {"shape": None, "count": 0, "files": {},
+                    "transform": transform.config}
+    files = changes(input_dir, format, manifest)
+    first = next(files, None)
+    shape = manifest["shape"]
+    if first is not None and shape is None:
+        shape = transform.load(first[0]).shape
+    if shape is None:
+        sys.exit("no {} files under {}".format(format, input_dir))
+    files = itertools.chain([first] if first else [], files)
+
+    workers = workers or os.cpu_count()
+    sink = NpySink(output, shape, transform.dtype, count=manifest["count"])
+    start_time = time.time()
+    added = 0
+    try:
+        with ProcessPoolExecutor(workers) as pool:
+            def finish(start, batch, future):
+                for i, ((file, size, mtime), sha256) in enumerate(
+                        zip(batch, future.result())):
+                    manifest["files"][file] = {
+                        "size": size, "mtime": mtime, "sha256": sha256,
+                        "row": start + i, "label": labeler(file)}
+
+            pending = deque()
+            while True:
+                batch = list(itertools.islice(files, batch_size))
+                if not batch:
+                    break
+                start = sink.count
+                sink.reserve(start + len(batch))
+                pending.append((start, batch, pool.submit(
+                    write_rows, output, shape, start,
+                    [file for file, _, _ in batch], transform)))
+                added += len(batch)
+                while len(pending) >= 2 * workers:
+                    finish(*pending.popleft())
+            while pending:
+                finish(*pending.popleft())
+        # Labels are cheap to redo, so a new labeler applies to every row.
+        for file, entry in manifest["files"].items():
+            entry["label"] = labeler(file)
+    finally:
+        sink.close()
+        manifest.update(shape=list(shape), count=sink.count)
+        save_manifest(output, manifest)
+        write_index(output, manifest)
+    if csv_path:
+        export_csv(output, csv_path)
+    print("added {} images of {} to {} ({} rows, {} live) in {:.1f} "
+          "seconds".format(added, tuple(shape), output, sink.count,
+                           len(manifest["files"]), time.time() - start_time))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert a folder of images into a .npy dataset.")
+    parser.add_argument("--input", default="images")
+    parser.add_argument("--output", default=OUTPUT_NPY)
+    parser.add_argument("--format", default=".png",
+                        help="file extension to pick up")
+    parser.add_argument("--csv", dest="csv_path",
+                        help="also export a CSV, one flattened image per row")
+    parser.add_argument("--workers", type=int,
+                        help="decoding processes (default: one per CPU)")
+    parser.add_argument("--batch-size", type=int, default=64,
+                        help="files per worker task")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="reconvert everything instead of only changes")
+    parser.add_argument("--size", type=int, nargs=2,
+                        metavar=("WIDTH", "HEIGHT"),
+                        help="resize every image to this size")
+    parser.add_argument("--mode", help="convert every image to this PIL "
+                        "mode, e.g. RGB or L")
+    parser.add_argument("--dtype", default="uint8",
+                        help="row dtype; float rows are scaled to [0, 1]")
+    parser.add_argument("--mean", type=float, nargs="+",
+                        help="per-channel mean to normalize float rows with")
+    parser.add_argument("--std", type=float, nargs="+",
+                        help="per-channel std to normalize float rows with")
+    parser.add_argument("--label-from", default="constant",
+                        choices=["constant", "dir", "file"],
+                        help="label every image with LABEL, its directory "
+                        "name, or from --labels")
+    parser.add_argument("--labels", help="CSV of path,label rows")
+    args = parser.parse_args()
+    convert(args.input, args.output, args.format, args.csv_path,
+            args.workers, args.batch_size, args.rebuild,
+            Transform(args.size, args.mode, args.dtype, args.mean, args.std),
+            make_labeler(args.label_from, args.labels, args.input))
@@ -1,10 +1,13 @@
 import os
+import uuid
 import PIL.Image
 import torch
-import numpy as np
 from transformers import AutoModelForCausalLM
 from janus.models import MultiModalityCausalLM, VLChatProcessor
 
+from encoder import ImageWriter
+from janus_engine import DecodeEngine, build_cfg_batch, decode_images
+
 
 # specify the path to the model
 model_path = "deepseek-ai/Janus-1.3B"
@@ -43,55 +46,48 @@ def generate(
     image_token_num_per_image: int = 576,
     img_size: int = 384,
     patch_size: int = 16,
+    engine: DecodeEngine = None,
+    decode_chunk_size: int = 4,
+    out_dir: str = "generated_samples",
 ):
-    input_ids = vl_chat_processor.tokenizer.encode(prompt)
-    input_ids = torch.LongTensor(input_ids)
-
-    tokens = torch.zeros((parallel_size*2, len(input_ids)), dtype=torch.int).cuda()
-    for i in range(parallel_size*2):
-        tokens[i, :] = input_ids
-        if i % 2 != 0:
-            tokens[i, 1:-1] = vl_chat_processor.pad_id
-
-    inputs_embeds = mmgpt.language_model.get_input_embeddings()(tokens)
-
-    generated_tokens = torch.zeros((parallel_size, image_token_num_per_image), dtype=torch.int).cuda()
-
-    for i in range(image_token_num_per_image):
-        outputs = mmgpt.language_model.model(inputs_embeds=inputs_embeds, use_cache=True, past_key_values=outputs.past_key_values if i != 0 else None)
-        hidden_states = outputs.last_hidden_state
-        
-        logits = mmgpt.gen_head(hidden_states[:, -1, :])
-        logit_cond = logits[0::2, :]
-        logit_uncond = logits[1::2, :]
-        
-        logits = logit_uncond + cfg_weight * (logit_cond-logit_uncond)
-        probs = torch.softmax(logits / temperature, dim=-1)
-
-        next_token = torch.multinomial(probs, num_samples=1)
-        generated_tokens[:, i] = next_token.squeeze(dim=-1)
-
-        next_token = torch.cat([next_token.unsqueeze(dim=1), next_token.unsqueeze(dim=1)], dim=1).view(-1)
-        img_embeds = mmgpt.prepare_gen_img_embeds(next_token)
-        inputs_embeds = img_embeds.unsqueeze(dim=1)
-
-
-    dec = mmgpt.gen_vision_model.decode_code(generated_tokens.to(dtype=torch.int), shape=[parallel_size, 8, img_size//patch_size, img_size//patch_size])
-    dec = dec.to(torch.float32).cpu().numpy().transpose(0, 2, 3, 1)
-
-    dec = np.clip((dec + 1) / 2 * 255, 0, 255)
-
-    visual_img = np.zeros((parallel_size, img_size, img_size, 3), dtype=np.uint8)
-    visual_img[:, :, :] = dec
-
-    os.makedirs('generated_samples', exist_ok=True)
-    for i in range(parallel_size):
-        save_path = os.path.join('generated_samples', "img_{}.jpg".format(i))
-        PIL.Image.fromarray(visual_img[i]).save(save_path)
-
-
+    # prompt may be a list of prompts, which are then generated in one batch
+    # of len(prompt) * parallel_size images.
+    prompts = [prompt] if isinstance(prompt, str) else prompt
+    input_ids = [vl_chat_processor.tokenizer.encode(p) for p in prompts]
+    tokens, attention_mask, position_ids = build_cfg_batch(
+        input_ids, vl_chat_processor.pad_id, parallel_size)
+    tokens = tokens.cuda()
+    attention_mask = attention_mask.cuda()
+    position_ids = position_ids.cuda()
+
+    # The engine keeps its preallocated KV cache between calls.
+    engine = engine or DecodeEngine(mmgpt)
+    generated_tokens = engine.generate(
+        tokens, attention_mask, position_ids, image_token_num_per_image,
+        cfg_weight=cfg_weight, temperature=temperature)
+
+    # Each call writes to its own directory so concurrent runs don't
+    # overwrite each other. Images are encoded on the writer's threads
+    # while the next chunk decodes.
+    out_dir = os.path.join(out_dir, uuid.uuid4().hex)
+    writer = ImageWriter(out_dir, format="jpeg", quality=75)
+    futures = [
+        writer.submit(PIL.Image.fromarray(image),
+                      os.path.join(out_dir, "img_{}.jpg".format(i)))
+        for i, image in enumerate(decode_images(
+            mmgpt, generated_tokens, img_size, patch_size, decode_chunk_size))
+    ]
+    writer.close()
+    paths = [future.result() for future in futures]
+    print("saved " + out_dir)
+    return paths
+
+
+# Compiling the decode step (CUDA graphs) is opt-in with JANUS_COMPILE=1
+# until it has been measured against the eager engine on a GPU.
 generate(
     vl_gpt,
     vl_chat_processor,
     prompt,
+    engine=DecodeEngine(vl_gpt, compile=bool(os.environ.get("JANUS_COMPILE"))),
 )
\ No newline at end of file
@@ -0,0 +1,673 @@
+import argparse
+import itertools
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+from transformers import DynamicCache, StaticCache
+
+
+def build_cfg_batch(input_ids, pad_id, parallel_size):
+    """Builds the interleaved conditional/unconditional batch for Janus CFG.
+
+    input_ids is one prompt (a list or 1-D tensor of token ids) or a list of
+    prompts. Each prompt becomes parallel_size (conditional, unconditional)
+    row pairs, where the unconditional row keeps only the first and last
+    token and pads everything in between. Prompts of different lengths are
+    left-padded so that all of them end, and start generating, at the same
+    position.
+
+    Returns (tokens, attention_mask, position_ids), each of shape
+    (num_prompts * parallel_size * 2, max_len).
+    """
+    if torch.as_tensor(input_ids[0]).dim() == 0:
+        input_ids = [input_ids]
+    prompts = [torch.as_tensor(ids, dtype=torch.long) for ids in input_ids]
+    lengths = torch.tensor([len(ids) for ids in prompts])
+    max_len = int(lengths.max())
+
+    # Left padding is right padding of the reversed prompts, reversed back.
+    cond = torch.nn.utils.rnn.pad_sequence(
+        [ids.flip(0) for ids in prompts], batch_first=True,
+        padding_value=pad_id).flip(1)
+    positions = torch.arange(max_len)
+    start = (max_len - lengths).unsqueeze(1)
+    mask = positions >= start
+    uncond = cond.masked_fill((positions > start) & (positions < max_len - 1),
+                              pad_id)
+    position_ids = (positions - start).clamp(min=0)
+
+    def pairs(cond_rows, uncond_rows):
+        rows = torch.stack([cond_rows, uncond_rows], dim=1)
+        return rows.repeat_interleave(parallel_size, dim=0).reshape(
+            -1, max_len)
+
+    return (pairs(cond, uncond), pairs(mask, mask).long(),
+            pairs(position_ids, position_ids))
+
+
+def sample(logits, cfg_weight, temperature, generator=None):
+    """Mixes each (conditional, unconditional) row pair and samples a token.
+
+    Returns one token per pair, repeated for both rows of the pair.
+    """
+    logit_cond = logits[0::2, :]
+    logit_uncond = logits[1::2, :]
+    logits = logit_uncond + cfg_weight * (logit_cond - logit_uncond)
+    probs = torch.softmax(logits / temperature, dim=-1)
+    next_token = torch.multinomial(probs, num_samples=1, generator=generator)
+    return next_token.squeeze(dim=-1)
+
+
+@torch.inference_mode()
+def dynamic_generate(mmgpt, tokens, attention_mask, position_ids, num_tokens,
+                     cfg_weight=5, temperature=1, generator=None):
+    """The original decode loop, with a KV cache that grows every step."""
+    inputs_embeds = mmgpt.language_model.get_input_embeddings()(tokens)
+    generated_tokens = torch.zeros((tokens.shape[0] // 2, num_tokens),
+                                   dtype=torch.int, device=tokens.device)
+    past_key_values = None
+    for i in range(num_tokens):
+        outputs = mmgpt.language_model.model(
+            inputs_embeds=inputs_embeds, attention_mask=attention_mask,
+            position_ids=position_ids, use_cache=True,
+            past_key_values=past_key_values)
+        past_key_values = outputs.past_key_values
+        attention_mask = torch.cat([attention_mask, attention_mask.new_ones(
+            (attention_mask.shape[0], 1))], dim=1)
+        position_ids = position_ids[:, -1:] + 1
+        logits = mmgpt.gen_head(outputs.last_hidden_state[:, -1, :])
+        next_token = sample(logits, cfg_weight, temperature, generator)
+        generated_tokens[:, i] = next_token
+        inputs_embeds = mmgpt.prepare_gen_img_embeds(
+            next_token.repeat_interleave(2)).unsqueeze(dim=1)
+    return generated_tokens
+
+
+class DecodeEngine:
+    """Generates Janus image tokens with a preallocated KV cache.
+
+    The cache holds the prompt plus every image token up front, so decoding
+    never reallocates it, and every decode step has the same shapes: one
+    token per row attending over the whole cache, with positions not yet
+    written masked out. That makes the step cheap to compile (compile=True)
+    and, on CUDA, to capture as a graph. The cache is kept between calls and
+    only reallocated when a bigger batch or longer prompt comes along.
+    """
+
+    def __init__(self, mmgpt, compile=False):
+        self.mmgpt = mmgpt
+        self.model = mmgpt.language_model.model
+        self.cache = None
+        self.step = self._step
+        if compile:
+            mode = "reduce-overhead" if self.device.type == "cuda" else None
+            self.step = torch.compile(self._step, mode=mode, fullgraph=True)
+
+    @property
+    def device(self):
+        return next(self.model.parameters()).device
+
+    def _cache_for(self, batch_size, length):
+        if (self.cache is None or self.cache.max_batch_size != batch_size
+                or self.cache.max_cache_len < length):
+            self.cache = StaticCache(
+                self.model.config, batch_size, length, self.device,
+                next(self.model.parameters()).dtype)
+        else:
+            self.cache.reset()
+        return self.cache
+
+    def _step(self, inputs_embeds, attention_mask, position_ids,
+              cache_position):
+        outputs = self.model(
+            inputs_embeds=inputs_embeds, attention_mask=attention_mask,
+            position_ids=position_ids, cache_position=cache_position,
+            past_key_values=self.cache, use_cache=True)
+        return self.mmgpt.gen_head(outputs.last_hidden_state[:, -1, :])
+
+    @torch.inference_mode()
+    def generate(self, tokens, attention_mask, position_ids, num_tokens,
+                 cfg_weight=5, temperature=1, generator=None):
+        """Takes the output of build_cfg_batch (on the model's device).
+
+        Returns (num_rows // 2, num_tokens) image token ids.
+        """
+        batch_size, prompt_len = tokens.shape
+        cache = self._cache_for(batch_size, prompt_len + num_tokens)
+        # Positions past the prompt are all real tokens once written, and
+        # the causal mask hides them until then.
+        mask = attention_mask.new_ones((batch_size, cache.max_cache_len))
+        mask[:, :prompt_len] = attention_mask
+
+        generated_tokens = torch.zeros((batch_size // 2, num_tokens),
+                                       dtype=torch.int, device=tokens.device)
+        inputs_embeds = self.mmgpt.language_model.get_input_embeddings()(
+            tokens)
+        logits = self._step(inputs_embeds, mask, position_ids,
+                            torch.arange(prompt_len, device=tokens.device))
+        position_ids = position_ids[:, -1:].clone()
+        cache_position = torch.tensor([prompt_len - 1], device=tokens.device)
+        for i in range(num_tokens):
+            next_token = sample(logits, cfg_weight, temperature, generator)
+            generated_tokens[:, i] = next_token
+            if i == num_tokens - 1:
+                break
+            inputs_embeds = self.mmgpt.prepare_gen_img_embeds(
+                next_token.repeat_interleave(2)).unsqueeze(dim=1)
+            position_ids += 1
+            cache_position += 1
+            logits = self.step(inputs_embeds, mask, position_ids,
+                               cache_position)
+        return generated_tokens
+
+
+class _PrefixNode:
+    def __init__(self, tokens=(), keys=None, values=None, parent=None):
+        self.tokens = tokens
+        # Per layer, (1, heads, len(tokens), head_dim).
+        self.keys = keys or []
+        self.values = values or []
+        self.parent = parent
+        self.children = {}
+        self.last_used = 0
+
+
+class PrefixCache:
+    """Prefilled KV cache of token-id prefixes, in a radix tree.
+
+    Each edge holds a run of tokens and their keys and values, so prompts
+    that share leading tokens (the SFT template and system prompt, or the
+    unconditional rows, which are all padding after the first token) share
+    that part of the tree and only prefill what follows it. Keys and values
+    only depend on the tokens before them, so this is exact for unpadded
+    rows that start at position 0. Least recently used leaves are evicted
+    once more than max_tokens tokens are cached.
+    """
+
+    def __init__(self, max_tokens=8192):
+        self.max_tokens = max_tokens
+        self.root = _PrefixNode()
+        self.tokens = 0
+        self.clock = itertools.count(1)
+        self.hits = 0
+        self.misses = 0
+
+    def match(self, ids):
+        """Returns (length, keys, values) for the longest cached prefix.
+
+        keys and values are per-layer tensors covering ids[:length], or
+        empty lists if nothing matched.
+        """
+        node, length, keys, values = self.root, 0, [], []
+        while length < len(ids):
+            child = node.children.get(ids[length])
+            if child is None:
+                break
+            common = _common_length(child.tokens, ids[length:])
+            keys.append([k[:, :, :common] for k in child.keys])
+            values.append([v[:, :, :common] for v in child.values])
+            length += common
+            self._touch(child)
+            if common < len(child.tokens):
+                break
+            node = child
+        self.hits += length
+        self.misses += len(ids) - length
+        if not keys:
+            return 0, [], []
+        return (length, [torch.cat(k, dim=2) for k in zip(*keys)],
+                [torch.cat(v, dim=2) for v in zip(*values)])
+
+    def insert(self, ids, keys, values):
+        """Stores per-layer keys and values (1, heads, len(ids), head_dim)."""
+        ids = tuple(ids)
+        node, length = self.root, 0
+        while length < len(ids):
+            child = node.children.get(ids[length])
+            if child is None:
+                leaf = _PrefixNode(
+                    ids[length:], [k[:, :, length:].clone() for k in keys],
+                    [v[:, :, length:].clone() for v in values], node)
+                node.children[ids[length]] = leaf
+                self.tokens += len(leaf.tokens)
+                self._touch(leaf)
+                break
+            common = _common_length(child.tokens, ids[length:])
+            if common < len(child.tokens):
+                child = self._split(child, common)
+            length += common
+            node = child
+        self._evict()
+
+    def _split(self, node, at):
+        # node becomes the tail of a new node holding its first `at` tokens.
+        head = _PrefixNode(node.tokens[:at], [k[:, :, :at] for k in node.keys],
+                           [v[:, :, :at] for v in node.values], node.parent)
+        head.last_used = node.last_used
+        node.parent.children[node.tokens[0]] = head
+        node.tokens = node.tokens[at:]
+        node.keys = [k[:, :, at:] for k in node.keys]
+        node.values = [v[:, :, at:] for v in node.values]
+        node.parent = head
+        head.children[node.tokens[0]] = node
+        return head
+
+    def _touch(self, node):
+        now = next(self.clock)
+        while node is not None:
+            node.last_used = now
+            node = node.parent
+
+    def _evict(self):
+        while self.tokens > self.max_tokens:
+            leaves, stack = [], [self.root]
+            while stack:
+                node = stack.pop()
+                stack.extend(node.children.values())
+                if not node.children and node is not self.root:
+                    leaves.append(node)
+            leaf = min(leaves, key=lambda n: n.last_used)
+            del leaf.parent.children[leaf.tokens[0]]
+            self.tokens -= len(leaf.tokens)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "tokens": self.tokens}
+
+
+def _common_length(a, b):
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+class _Sequence:
+    """One request in a ContinuousEngine: parallel_size CFG row pairs."""
+
+    def __init__(self, input_ids, pad_id, parallel_size, num_tokens,
+                 cfg_weight, temperature, generator):
+        # Every pair of a request starts from the same two prompt rows, so
+        # only those are prefilled.
+        self.prompt_rows = build_cfg_batch(input_ids, pad_id, 1)[0]
+        self.parallel_size = parallel_size
+        self.num_tokens = num_tokens
+        self.cfg_weight = cfg_weight
+        self.temperature = temperature
+        self.generator = generator
+        self.tokens = torch.zeros((parallel_size, num_tokens),
+                                  dtype=torch.int)
+        self.step = 0
+        self.future = Future()
+
+    @property
+    def rows(self):
+        return self.parallel_size * 2
+
+    @property
+    def finished(self):
+        return self.step == self.num_tokens
+
+
+def _left_pad(tensor, length, dim):
+    pad = length - tensor.shape[dim]
+    if pad == 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = pad
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+
+class ContinuousEngine:
+    """Continuous batching of Janus image-token generation.
+
+    Requests are admitted into the running batch between decode steps as
+    long as there are free slots (one slot per image, i.e. per CFG row
+    pair), and leave it as soon as their last token is sampled, so a long
+    request no longer holds up the ones that arrive after it. A new request
+    is prefilled on its own and its KV cache joined to the batch's, with
+    rows left-padded to a common length; each row keeps its own attention
+    mask and positions, and each request its own CFG weight, temperature
+    and generator. With a prefix_cache, prefill reuses the keys and values
+    of earlier prompts' leading tokens.
+    """
+
+    def __init__(self, mmgpt, pad_id, max_slots=16, prefix_cache=None):
+        self.mmgpt = mmgpt
+        self.model = mmgpt.language_model.model
+        self.pad_id = pad_id
+        self.max_slots = max_slots
+        self.prefix_cache = prefix_cache
+        self.pending = []
+        self.active = []
+        self.cache = None
+        self.mask = None
+        self.positions = None
+        self.closed = False
+        self.cond = threading.Condition()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, input_ids, parallel_size=1, num_tokens=576,
+               cfg_weight=5, temperature=1, generator=None):
+        """Returns a future of (parallel_size, num_tokens) image token ids."""
+        if parallel_size > self.max_slots:
+            raise ValueError("parallel_size {} is over max_slots {}".format(
+                parallel_size, self.max_slots))
+        sequence = _Sequence(input_ids, self.pad_id, parallel_size,
+                             num_tokens, cfg_weight, temperature, generator)
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("engine is closed")
+            self.pending.append(sequence)
+            self.cond.notify()
+        return sequence.future
+
+    def busy(self):
+        with self.cond:
+            return bool(self.pending or self.active)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.worker.join()
+
+    def _take_admissible(self):
+        with self.cond:
+            self.cond.wait_for(
+                lambda: self.pending or self.active or self.closed)
+            if self.closed and not self.active:
+                for sequence in self.pending:
+                    sequence.future.set_exception(
+                        RuntimeError("engine is closed"))
+                self.pending = []
+                return None
+            free = self.max_slots - sum(s.parallel_size for s in self.active)
+            admitted = []
+            # First come, first served: a big request isn't overtaken by
+            # smaller ones behind it.
+            while self.pending and self.pending[0].parallel_size <= free:
+                free -= self.pending[0].parallel_size
+                admitted.append(self.pending.pop(0))
+            return admitted
+
+    def _run(self):
+        while True:
+            admitted = self._take_admissible()
+            if admitted is None:
+                return
+            try:
+                with torch.inference_mode():
+                    for sequence in admitted:
+                        self._admit(sequence)
+                    self._retire()
+                    if self.active:
+                        self._step()
+                        self._retire()
+            except Exception as e:
+                for sequence in self.active + admitted:
+                    if not sequence.future.done():
+                        sequence.future.set_exception(e)
+                self.active = []
+                self.cache = None
+
+    def _prefill(self, ids):
+        """Prefills one unpadded row.
+
+        Returns per-layer keys and values and the last hidden state.
+        """
+        device = next(self.model.parameters()).device
+        cache = DynamicCache()
+        start = 0
+        if self.prefix_cache is not None:
+            # At least the last token is run, for its hidden state.
+            start, keys, values = self.prefix_cache.match(ids[:-1])
+            cache.key_cache, cache.value_cache = keys, values
+            cache._seen_tokens = start
+        tokens = torch.tensor([ids[start:]], device=device)
+        outputs = self.model(
+            inputs_embeds=self.mmgpt.language_model.get_input_embeddings()(
+                tokens),
+            attention_mask=torch.ones((1, len(ids)), dtype=torch.long,
+                                      device=device),
+            position_ids=torch.arange(start, len(ids), device=device)[None],
+            past_key_values=cache, use_cache=True)
+        if self.prefix_cache is not None:
+            self.prefix_cache.insert(ids, cache.key_cache, cache.value_cache)
+        return (cache.key_cache, cache.value_cache,
+                outputs.last_hidden_state[:, -1, :])
+
+    def _admit(self, sequence):
+        cond, uncond = (self._prefill(row.tolist())
+                        for row in sequence.prompt_rows)
+        # (cond, uncond) rows repeated for every pair of the request.
+        rows = torch.tensor([0, 1] * sequence.parallel_size,
+                            device=cond[2].device)
+        cache = DynamicCache()
+        for layer in range(len(cond[0])):
+            cache.key_cache.append(
+                torch.cat([cond[0][layer], uncond[0][layer]])[rows])
+            cache.value_cache.append(
+                torch.cat([cond[1][layer], uncond[1][layer]])[rows])
+        length = cache.key_cache[0].shape[2]
+        cache._seen_tokens = length
+        mask = torch.ones((sequence.rows, length), dtype=torch.long,
+                          device=rows.device)
+        positions = torch.full((sequence.rows, 1), length, device=rows.device)
+        self._sample(sequence, self.mmgpt.gen_head(
+            torch.cat([cond[2], uncond[2]])[rows]))
+        if self.cache is None:
+            self.cache, self.mask, self.positions = cache, mask, positions
+        else:
+            length = max(self.mask.shape[1], mask.shape[1])
+            for layer in range(len(cache.key_cache)):
+                for old, new in ((self.cache.key_cache, cache.key_cache),
+                                 (self.cache.value_cache, cache.value_cache)):
+                    old[layer] = torch.cat([_left_pad(old[layer], length, 2),
+                                            _left_pad(new[layer], length, 2)])
+            self.mask = torch.cat([_left_pad(self.mask, length, 1),
+                                   _left_pad(mask, length, 1)])
+            self.positions = torch.cat([self.positions, positions])
+            self.cache._seen_tokens = length
+        self.active.append(sequence)
+
+    def _retire(self):
+        done = [s for s in self.active if s.finished]
+        if not done:
+            return
+        keep, row = [], 0
+        for sequence in self.active:
+            if not sequence.finished:
+                keep.extend(range(row, row + sequence.rows))
+            row += sequence.rows
+        self.active = [s for s in self.active if not s.finished]
+        if not self.active:
+            self.cache = self.mask = self.positions = None
+        else:
+            keep = torch.tensor(keep, device=self.mask.device)
+            mask = self.mask[keep]
+            # Columns that are padding in every remaining row go too.
+            start = int(mask.any(dim=0).nonzero()[0])
+            self.mask = mask[:, start:]
+            self.positions = self.positions[keep]
+            for cache in (self.cache.key_cache, self.cache.value_cache):
+                for layer in range(len(cache)):
+                    cache[layer] = cache[layer][keep, :, start:]
+            self.cache._seen_tokens = self.mask.shape[1]
+        for sequence in done:
+            sequence.future.set_result(sequence.tokens)
+
+    def _step(self):
+        next_tokens = torch.cat([s.tokens[:, s.step - 1]
+                                 for s in self.active])
+        device = self.mask.device
+        inputs_embeds = self.mmgpt.prepare_gen_img_embeds(
+            next_tokens.to(device).repeat_interleave(2)).unsqueeze(dim=1)
+        self.mask = torch.cat(
+            [self.mask, self.mask.new_ones((self.mask.shape[0], 1))], dim=1)
+        outputs = self.model(
+            inputs_embeds=inputs_embeds, attention_mask=self.mask,
+            position_ids=self.positions, past_key_values=self.cache,
+            use_cache=True)
+        self.positions = self.positions + 1
+        logits = self.mmgpt.gen_head(outputs.last_hidden_state[:, -1, :])
+        row = 0
+        for sequence in self.active:
+            self._sample(sequence, logits[row:row + sequence.rows])
+            row += sequence.rows
+
+    def _sample(self, sequence, logits):
+        next_token = sample(logits, sequence.cfg_weight, sequence.temperature,
+                            sequence.generator)
+        sequence.tokens[:, sequence.step] = next_token.cpu()
+        sequence.step += 1
+
+
+def decode_images(mmgpt, generated_tokens, img_size=384, patch_size=16,
+                  chunk_size=4):
+    """Decodes image tokens chunk_size images at a time.
+
+    Yields (H, W, 3) uint8 arrays. Each chunk is converted to uint8 before
+    it leaves the device, so the host only ever sees the final pixels.
+    """
+    side = img_size // patch_size
+    for start in range(0, len(generated_tokens), chunk_size):
+        chunk = generated_tokens[start:start + chunk_size].to(dtype=torch.int)
+        dec = mmgpt.gen_vision_model.decode_code(
+            chunk, shape=[len(chunk), 8, side, side])
+        dec = ((dec.float() + 1) / 2 * 255).clamp(0, 255).to(torch.uint8)
+        yield from dec.permute(0, 2, 3, 1).cpu().numpy()
+
+
+class TinyJanus(torch.nn.Module):
+    """A randomly initialised model with Janus's generation interface."""
+
+    def __init__(self, hidden_size=256, num_layers=4, vocab_size=1000,
+                 image_vocab_size=1024):
+        super().__init__()
+        from transformers import LlamaConfig, LlamaForCausalLM
+        self.language_model = LlamaForCausalLM(LlamaConfig(
+            vocab_size=vocab_size, hidden_size=hidden_size,
+            intermediate_size=hidden_size * 4, num_hidden_layers=num_layers,
+            num_attention_heads=8, num_key_value_heads=8,
+            max_position_embeddings=2048))
+        self.gen_head = torch.nn.Sequential(
+            torch.nn.Linear(hidden_size, hidden_size), torch.nn.GELU(),
+            torch.nn.Linear(hidden_size, image_vocab_size))
+        self.gen_embed = torch.nn.Embedding(image_vocab_size, 8)
+        self.gen_aligner = torch.nn.Linear(8, hidden_size)
+
+    def prepare_gen_img_embeds(self, image_ids):
+        return self.gen_aligner(self.gen_embed(image_ids))
+
+
+def benchmark(prompt_len=48, parallel_size=4, num_tokens=144, repeats=3,
+              compile=False):
+    """Decodes with every engine and checks they produce the same tokens.
+
+    The timings are not representative. On the tiny CPU model each step is
+    too cheap for launch overhead to matter, and the static cache attends
+    over its whole preallocated length, so static and compiled decoding come
+    out about even with the dynamic loop or slower. The speedup this engine
+    is for comes from CUDA graphs (compile=True on a CUDA device), so
+    throughput has to be measured on the GPU with the real model.
+    """
+    torch.manual_seed(0)
+    mmgpt = TinyJanus().eval()
+    input_ids = torch.randint(1, 1000, (prompt_len,))
+    batch = build_cfg_batch(input_ids, 0, parallel_size)
+    runs = {
+        "dynamic": lambda g: dynamic_generate(
+            mmgpt, *batch, num_tokens, generator=g),
+        "static": lambda g, engine=DecodeEngine(mmgpt): engine.generate(
+            *batch, num_tokens, generator=g),
+    }
+    if compile:
+        runs["compiled"] = lambda g, engine=DecodeEngine(
+            mmgpt, compile=True): engine.generate(
+                *batch, num_tokens, generator=g)
+    results = {}
+    for name, run in runs.items():
+        run(torch.Generator().manual_seed(0))  # warm up / compile
+        start = time.perf_counter()
+        for _ in range(repeats):
+            results[name] = run(torch.Generator().manual_seed(0))
+        seconds = (time.perf_counter() - start) / repeats
+        print("{:<8} {:8.1f} tokens/s".format(
+            name, parallel_size * num_tokens / seconds))
+    for name in list(runs)[1:]:
+        same = (results["dynamic"] == results[name]).float().mean()
+        print("{} tokens matching dynamic: {:.1%}".format(name, same.item()))
+
+
+def benchmark_continuous(num_requests=8, parallel_size=2, num_tokens=96,
+                         interval=0.2, max_slots=8):
+    """Staggered requests served one call at a time vs. continuously."""
+    torch.manual_seed(0)
+    mmgpt = TinyJanus().eval()
+    # Like SFT-formatted prompts: a shared template, then the user's text.
+    template = torch.randint(1, 1000, (48,)).tolist()
+    prompts = [template + torch.randint(1, 1000, (int(n),)).tolist()
+               for n in torch.randint(8, 32, (num_requests,))]
+
+    def serial(input_ids, start):
+        # One request at a time, as janus.generate does.
+        engine = DecodeEngine(mmgpt)
+        finished = []
+        for i, ids in enumerate(input_ids):
+            time.sleep(max(0.0, start + i * interval - time.perf_counter()))
+            engine.generate(*build_cfg_batch(ids, 0, parallel_size),
+                            num_tokens)
+            finished.append(time.perf_counter())
+        return finished
+
+    def continuous(input_ids, start, prefix_cache=None):
+        engine = ContinuousEngine(mmgpt, 0, max_slots, prefix_cache)
+        futures = []
+        for i, ids in enumerate(input_ids):
+            time.sleep(max(0.0, start + i * interval - time.perf_counter()))
+            future = engine.submit(ids, parallel_size, num_tokens)
+            future.add_done_callback(
+                lambda f: setattr(f, "finished", time.perf_counter()))
+            futures.append(future)
+        for future in futures:
+            future.result()
+        engine.close()
+        return [future.finished for future in futures]
+
+    def prefix(input_ids, start):
+        return continuous(input_ids, start, PrefixCache())
+
+    for name, run in (("serial", serial), ("continuous", continuous),
+                      ("prefix", prefix)):
+        start = time.perf_counter()
+        finished = run(prompts, start)
+        latency = [f - (start + i * interval) for i, f in enumerate(finished)]
+        total = max(finished) - start
+        print("{:<10} {:8.1f} tokens/s, mean latency {:.2f}s".format(
+            name, num_requests * parallel_size * num_tokens / total,
+            sum(latency) / len(latency)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check Janus decode engines against each other on a "
+                    "tiny random model (CPU). Timings are only indicative, "
+                    "see benchmark().")
+    parser.add_argument("--prompt-len", type=int, default=48)
+    parser.add_argument("--parallel-size", type=int, default=4)
+    parser.add_argument("--tokens", type=int, default=144)
+    parser.add_argument("--compile", action="store_true")
+    parser.add_argument("--continuous", action="store_true",
+                        help="benchmark continuous batching instead")
+    args = parser.parse_args()
+    if args.continuous:
+        benchmark_continuous(parallel_size=args.parallel_size,
+                             num_tokens=args.tokens)
+    else:
+        benchmark(args.prompt_len, args.parallel_size, args.tokens,
+                  compile=args.compile)
@@ -0,0 +1,426 @@
+import math
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import CancelledError
+
+from PIL import Image
+
+import batching
+import encoder
+import metrics
+import scheduler
+
+
+class Job:
+    def __init__(self, prompt, cfg_scale=7.0, model_id=None,
+                 negative_prompt="", seed=None, tenant="default",
+                 priority="standard"):
+        self.id = uuid.uuid4().hex
+        self.model_id = model_id
+        self.tenant = tenant
+        self.priority = priority
+        self.cost = scheduler.estimate_cost(model_id)
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.seed = seed
+        self.cache_hit = False
+        self.cfg_scale = cfg_scale
+        self.status = "queued"
+        self.path = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_token = batching.CancelToken()
+        # Latest progress or status event, for streaming to clients.
+        self.event = None
+        self.version = 0
+        self.cond = threading.Condition()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "model_id": self.model_id,
+            "tenant": self.tenant,
+            "priority": self.priority,
+            "cost": self.cost,
+            "prompt": self.prompt,
+            "negative_prompt": self.negative_prompt,
+            "cfg_scale": self.cfg_scale,
+            "seed": self.seed,
+            "cache_hit": self.cache_hit,
+            "error": self.error,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed", "cancelled")
+
+    def publish(self, event):
+        with self.cond:
+            self.event = event
+            self.version += 1
+            self.cond.notify_all()
+
+    def publish_status(self):
+        self.publish(dict(self.to_dict(), type="status"))
+
+    def wait_event(self, version, timeout=None):
+        """Waits for an event newer than version.
+
+        Returns (event, version); the event is None on timeout. Clients that
+        fall behind skip straight to the latest event.
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.version != version,
+                                      timeout):
+                return None, version
+            return self.event, self.version
+
+
+class Overloaded(Exception):
+    """Raised by JobQueue.submit when a job is over an admission limit.
+
+    retry_after is the number of seconds after which the job would likely be
+    admitted.
+    """
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+class JobQueue:
+    """In-process job queue drained by a single worker thread.
+
+    The worker builds the generator itself (via generator_factory), so the
+    pipeline lives on the thread that runs it and HTTP threads only ever
+    enqueue and poll. Up to max_inflight jobs (by default the generator's
+    max_batch_size) are handed to the generator at once so it can batch
+    them; the rest wait in queue, a scheduler.FairQueue unless given, which
+    orders them by cost and tenant priority. Finished images go to writer,
+    and a job is done once its image is on disk.
+
+    submit() raises Overloaded instead of queueing once there are max_queued
+    waiting jobs, the estimated wait exceeds max_wait seconds, or a model
+    already has its limit of unfinished jobs (model_limits, falling back to
+    max_per_model). The estimated wait is the cost of all unfinished jobs
+    over the drain rate, the cost finished per busy second in the last
+    rate_window seconds.
+    """
+
+    def __init__(self, generator_factory, writer=None, max_inflight=None,
+                 max_finished=1000, preview_every=5, queue=None,
+                 max_queued=None, max_wait=None, max_per_model=None,
+                 model_limits=None, rate_window=300.0):
+        self.generator_factory = generator_factory
+        self.writer = writer or encoder.ImageWriter("outputs")
+        self.preview_every = preview_every
+        self.max_inflight = max_inflight
+        self.max_finished = max_finished
+        self.jobs = OrderedDict()
+        self.queue = scheduler.FairQueue() if queue is None else queue
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.max_per_model = max_per_model
+        self.model_limits = model_limits or {}
+        self.rate_window = rate_window
+        self.unfinished = Counter()
+        self.unfinished_cost = 0.0
+        # (finished at, cost, busy seconds since the previous completion)
+        self.completed = deque()
+        self.running = 0
+        self.busy_since = None
+        self.rejected = 0
+        self.lock = threading.Lock()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, prompt, cfg_scale=7.0, model_id=None,
+               negative_prompt="", seed=None, tenant="default",
+               priority="standard"):
+        job = Job(prompt, cfg_scale, model_id, negative_prompt, seed,
+                  tenant, priority)
+        with self.lock:
+            try:
+                self._admit(job)
+            except Overloaded:
+                self.rejected += 1
+                raise
+            # Queued before anything is counted, so a job the queue refuses
+            # leaves no trace. The worker can't finish it before the lock is
+            # released.
+            self.queue.put(job, job.cost, tenant, priority)
+            self.jobs[job.id] = job
+            self.unfinished[job.model_id] += 1
+            self.unfinished_cost += job.cost
+        return job
+
+    def _admit(self, job):
+        rate = self._drain_rate()
+
+        def seconds(cost):
+            # Without a measured rate, clients are asked to back off briefly.
+            return max(1, math.ceil(cost / rate)) if rate else 1
+
+        queued = len(self.queue)
+        if self.max_queued is not None and queued >= self.max_queued:
+            # Wait for enough of the queue to drain, at its mean job cost.
+            # With max_queued=0 nothing ever queues, so this job's own cost
+            # stands in.
+            excess = queued - self.max_queued + 1
+            mean_cost = (self.queue.pending_cost / queued if queued
+                         else job.cost)
+            raise Overloaded("queue is full", seconds(excess * mean_cost))
+        limit = self.model_limits.get(job.model_id, self.max_per_model)
+        if limit is not None and self.unfinished[job.model_id] >= limit:
+            raise Overloaded("too many jobs for {}".format(job.model_id),
+                             seconds(job.cost))
+        if self.max_wait is not None and rate:
+            wait = (self.unfinished_cost + job.cost) / rate
+            if wait > self.max_wait:
+                raise Overloaded(
+                    "estimated wait of {:.1f}s is over {:.1f}s".format(
+                        wait, self.max_wait),
+                    seconds(self.unfinished_cost + job.cost
+                            - self.max_wait * rate))
+
+    def _drain_rate(self):
+        # Cost finished per second of running jobs. Idle time doesn't count,
+        # so a burst after a quiet period isn't judged by the quiet period.
+        cutoff = time.monotonic() - self.rate_window
+        while self.completed and self.completed[0][0] < cutoff:
+            self.completed.popleft()
+        busy = sum(c[2] for c in self.completed)
+        if busy <= 0:
+            return None
+        return sum(c[1] for c in self.completed) / busy
+
+    def stats(self):
+        with self.lock:
+            return {
+                "queued": len(self.queue),
+                "running": self.running,
+                "unfinished_cost": self.unfinished_cost,
+                "drain_rate": self._drain_rate() or 0.0,
+                "rejected": self.rejected,
+            }
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """Cancels a queued or running job.
+
+        Returns the job, or None if there is no such job. A queued job is
+        finished as cancelled right away and skipped by the worker; a running
+        one stops at the generator's next step.
+        """
+        job = self.get(job_id)
+        if job is None:
+            return None
+        with self.lock:
+            if job.finished:
+                return job
+            queued = job.status == "queued"
+        # Outside the lock: cancelling a running job's future runs _done.
+        job.cancel_token.cancel()
+        if queued:
+            self.queue.remove(job)
+            self._finish(job, cancelled=True)
+        return job
+
+    def _finish(self, job, path=None, error=None, cancelled=False):
+        with self.lock:
+            if job.finished:
+                return
+            if job.status == "running":
+                self._stopped(job, cancelled)
+            job.path = path
+            job.error = error
+            if cancelled:
+                job.status = "cancelled"
+            else:
+                job.status = "failed" if error is not None else "done"
+            job.finished_at = time.time()
+            self.unfinished[job.model_id] -= 1
+            self.unfinished_cost -= job.cost
+        job.publish_status()
+        with self.lock:
+            self.jobs.move_to_end(job.id)
+            finished = [j for j in self.jobs.values()
+                        if j.finished_at is not None]
+            for old in finished[:max(0, len(finished) - self.max_finished)]:
+                del self.jobs[old.id]
+
+    def _started(self, job):
+        job.status = "running"
+        if self.running == 0:
+            self.busy_since = time.monotonic()
+        self.running += 1
+
+    def _stopped(self, job, cancelled):
+        now = time.monotonic()
+        # Cancelled jobs didn't do their full cost of work, so their busy
+        # time is left out rather than counted against the rate.
+        if not cancelled:
+            self.completed.append((now, job.cost, now - self.busy_since))
+        self.busy_since = now
+        self.running -= 1
+
+    def _run(self):
+        try:
+            generator = self.generator_factory()
+        except Exception as e:
+            generator = None
+            load_error = "failed to load generator: {}".format(e)
+
+        max_inflight = self.max_inflight or getattr(
+            generator, "max_batch_size", 1)
+        slots = threading.Semaphore(max_inflight)
+
+        while True:
+            slots.acquire()
+            job = self.queue.get()
+            if generator is None:
+                self._finish(job, error=load_error)
+                slots.release()
+                continue
+            with self.lock:
+                if job.cancel_token.cancelled:
+                    slots.release()
+                    continue
+                self._started(job)
+            job.started_at = time.time()
+            job.publish_status()
+            metrics.observe("queue_wait", job.started_at - job.submitted_at,
+                            priority=job.priority)
+            try:
+                kwargs = {"model_id": job.model_id} if job.model_id else {}
+                future = generator.submit(
+                    job.prompt, job.cfg_scale,
+                    negative_prompt=job.negative_prompt, seed=job.seed,
+                    progress=self._progress(job), cancel=job.cancel_token,
+                    **kwargs)
+            except Exception as e:
+                self._finish(job, error=str(e))
+                slots.release()
+                continue
+            future.add_done_callback(
+                lambda f, job=job: self._done(job, f, slots))
+
+    def _progress(self, job):
+        def progress(step, total, eta, latents):
+            event = {"type": "progress", "id": job.id, "step": step,
+                     "total": total, "eta": eta}
+            # Every preview_every steps, attach a cheap preview projected
+            # straight from the latents rather than decoded by the VAE.
+            if (latents is not None and self.preview_every
+                    and step % self.preview_every == 0 and step < total):
+                import previews
+                event["preview"] = previews.data_url(
+                    previews.latent_to_image(latents))
+            job.publish(event)
+        return progress
+
+    def _done(self, job, future, slots):
+        # Runs on the generator's thread: only hand the image over, the
+        # encoding happens on the writer's pool.
+        try:
+            if future.cancelled() or isinstance(future.exception(),
+                                                CancelledError):
+                self._finish(job, cancelled=True)
+                return
+            error = future.exception()
+            if error is not None:
+                self._finish(job, error=str(error))
+            else:
+                image = future.result()
+                job.seed = image.info.get("seed", job.seed)
+                job.cache_hit = image.info.get("cache_hit", False)
+                self.writer.submit(image).add_done_callback(
+                    lambda f: self._written(job, f))
+        finally:
+            slots.release()
+
+    def _written(self, job, future):
+        error = future.exception()
+        if error is not None:
+            self._finish(job, error="failed to save image: {}".format(error))
+        else:
+            self._finish(job, path=future.result())
+
+
+class StubGenerator:
+    """Stands in for text2img.Text2Img on machines without a GPU.
+
+    Batches like Text2Img does and records every batch size it ran in
+    batch_sizes.
+    """
+
+    model_name = "stub"
+
+    def __init__(self, delay=0.5, size=64, max_batch_size=4, max_wait=0.01,
+                 num_inference_steps=10):
+        self.delay = delay
+        self.size = size
+        self.num_inference_steps = num_inference_steps
+        self.max_batch_size = max_batch_size
+        self.batch_sizes = []
+        self.batcher = batching.MicroBatcher(
+            self.run_batch, max_batch_size, max_wait)
+
+    def generate(self, prompt):
+        return self.generate_cfg(prompt=prompt, cfg_scale=7.0)
+
+    def generate_cfg(self, prompt, cfg_scale):
+        return self.submit(prompt, cfg_scale).result()
+
+    def submit(self, prompt, cfg_scale=7.0, height=None, width=None,
+               negative_prompt="", num_inference_steps=None, seed=None,
+               progress=None, cancel=None):
+        return self.batcher.submit(
+            (cfg_scale, num_inference_steps or self.num_inference_steps,
+             height, width),
+            batching.Request(prompt, negative_prompt, seed, progress, cancel),
+            cancel)
+
+    def run_batch(self, key, items):
+        self.batch_sizes.append(len(items))
+        steps = key[1]
+        for step in range(1, steps + 1):
+            if all(item.cancel is not None and item.cancel.cancelled
+                   for item in items):
+                return [CancelledError() for item in items]
+            time.sleep(self.delay / steps)
+            eta = self.delay / steps * (steps - step)
+            for item in items:
+                if item.progress is not None:
+                    item.progress(step, steps, eta, None)
+        return [self._image(item.prompt) for item in items]
+
+    def to(self, device):
+        return True
+
+    def memory_bytes(self, seen=None):
+        return self.size * self.size * 3
+
+    def busy(self):
+        return self.batcher.busy()
+
+    def add_idle_callback(self, callback):
+        self.batcher.add_idle_callback(callback)
+
+    def unload(self):
+        self.batcher.close()
+
+    def _image(self, prompt):
+        color = tuple(hash(prompt) >> shift & 0xff for shift in (0, 8, 16))
+        return Image.new("RGB", (self.size, self.size), color)
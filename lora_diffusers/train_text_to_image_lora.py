@@ -16,6 +16,8 @@
 """Fine-tuning script for Stable Diffusion for text2image with support for LoRA."""
 
 import argparse
+import gc
+import json
 import logging
 import math
 import os
@@ -44,6 +46,7 @@ from transformers import CLIPTextModel, CLIPTokenizer
 
 import diffusers
 from diffusers import AutoencoderKL, DDPMScheduler, DiffusionPipeline, StableDiffusionPipeline, UNet2DConditionModel
+from diffusers.models.autoencoders.vae import DiagonalGaussianDistribution
 from diffusers.optimization import get_scheduler
 from diffusers.training_utils import cast_training_params, compute_snr
 from diffusers.utils import check_min_version, convert_state_dict_to_diffusers, is_wandb_available
@@ -418,6 +421,36 @@ def parse_args():
         default=4,
         help=("The dimension of the LoRA update matrices."),
     )
+    parser.add_argument(
+        "--cache_latents",
+        action="store_true",
+        help=(
+            "Whether or not to encode every training image with the VAE once, before training, into a memory-mapped"
+            " latent store. The VAE will not be kept in memory during training. Needs `--center_crop`, since random"
+            " crops can't be cached; with `--random_flip` both orientations are cached."
+        ),
+    )
+    parser.add_argument(
+        "--latents_cache_dir",
+        type=str,
+        default=None,
+        help="Where to keep the latent store. Defaults to `latents_cache` in `--output_dir`.",
+    )
+    parser.add_argument(
+        "--pre_compute_text_embeddings",
+        action="store_true",
+        help=(
+            "Whether or not to pre-compute text embeddings. Every unique caption, including each alternative of a"
+            " caption list, is encoded once into a memory-mapped store, and the text encoder will not be kept in"
+            " memory during training, leaving more GPU memory available for training the rest of the model."
+        ),
+    )
+    parser.add_argument(
+        "--text_embeddings_cache_dir",
+        type=str,
+        default=None,
+        help="Where to keep the text embedding store. Defaults to `text_embeddings_cache` in `--output_dir`.",
+    )
 
     args = parser.parse_args()
     env_local_rank = int(os.environ.get("LOCAL_RANK", -1))
@@ -427,6 +460,8 @@ def parse_args():
     # Sanity checks
     if args.dataset_name is None and args.train_data_dir is None:
         raise ValueError("Need either a dataset name or a training folder.")
+    if args.cache_latents and not args.center_crop:
+        raise ValueError("`--cache_latents` needs `--center_crop`, random crops can't be cached.")
 
     return args
 
@@ -436,6 +471,124 @@ DATASET_NAME_MAPPING = {
 }
 
 
+def cache_latents(vae, dataset, image_column, args, accelerator, weight_dtype):
+    """Encodes every image in `dataset` with the VAE into a memory-mapped store and returns its path.
+
+    The store is an (images, variants, 2 * latent channels, height, width) float16 `.npy` file holding the parameters
+    of the VAE's latent distribution, so training still samples fresh latents every step. With `--random_flip` the
+    second variant is the mirror image. An existing store made with the same settings is reused.
+    """
+    cache_dir = args.latents_cache_dir or os.path.join(args.output_dir, "latents_cache")
+    path = os.path.join(cache_dir, "latents.npy")
+    key = {
+        "model": args.pretrained_model_name_or_path,
+        "revision": args.revision,
+        "variant": args.variant,
+        "dataset": args.dataset_name or args.train_data_dir,
+        "dataset_config_name": args.dataset_config_name,
+        "max_train_samples": args.max_train_samples,
+        "seed": args.seed,
+        "image_column": image_column,
+        "resolution": args.resolution,
+        "random_flip": args.random_flip,
+        "num_images": len(dataset),
+    }
+    if accelerator.is_main_process:
+        try:
+            with open(path + ".json") as f:
+                cached = json.load(f) == key
+        except FileNotFoundError:
+            cached = False
+        if not cached:
+            os.makedirs(cache_dir, exist_ok=True)
+            transform = transforms.Compose(
+                [
+                    transforms.Resize(args.resolution, interpolation=transforms.InterpolationMode.BILINEAR),
+                    transforms.CenterCrop(args.resolution),
+                    transforms.ToTensor(),
+                    transforms.Normalize([0.5], [0.5]),
+                ]
+            )
+            flips = [False, True] if args.random_flip else [False]
+            store = None
+            for start in tqdm(range(0, len(dataset), args.train_batch_size), desc="Caching latents"):
+                images = dataset[start : start + args.train_batch_size][image_column]
+                images = [image.convert("RGB") for image in images]
+                for variant, flip in enumerate(flips):
+                    pixel_values = torch.stack(
+                        [transform(transforms.functional.hflip(image) if flip else image) for image in images]
+                    )
+                    with torch.no_grad():
+                        params = vae.encode(pixel_values.to(accelerator.device, dtype=weight_dtype)).latent_dist
+                    params = params.parameters.float().cpu().numpy()
+                    if store is None:
+                        store = np.lib.format.open_memmap(
+                            path + ".tmp",
+                            mode="w+",
+                            dtype=np.float16,
+                            shape=(len(dataset), len(flips)) + params.shape[1:],
+                        )
+                    store[start : start + len(images), variant] = params
+            store.flush()
+            del store
+            os.replace(path + ".tmp", path)
+            with open(path + ".json", "w") as f:
+                json.dump(key, f)
+            logger.info(f"Cached latents of {len(dataset)} images in {path}")
+    accelerator.wait_for_everyone()
+    return path
+
+
+def cache_text_embeddings(text_encoder, tokenizer, captions, args, accelerator):
+    """Encodes `captions` with the text encoder into a memory-mapped store and returns its path.
+
+    Row i of the (captions, sequence length, hidden size) float16 `.npy` file is the embedding of `captions[i]`; the
+    captions are saved next to it, in the same order, as the index. An existing store of the same captions is reused.
+    """
+    cache_dir = args.text_embeddings_cache_dir or os.path.join(args.output_dir, "text_embeddings_cache")
+    path = os.path.join(cache_dir, "text_embeddings.npy")
+    key = {
+        "model": args.pretrained_model_name_or_path,
+        "revision": args.revision,
+        "max_length": tokenizer.model_max_length,
+        "captions": captions,
+    }
+    if accelerator.is_main_process:
+        try:
+            with open(path + ".json") as f:
+                cached = json.load(f) == key
+        except FileNotFoundError:
+            cached = False
+        if not cached:
+            os.makedirs(cache_dir, exist_ok=True)
+            store = None
+            for start in tqdm(range(0, len(captions), args.train_batch_size), desc="Caching text embeddings"):
+                batch = captions[start : start + args.train_batch_size]
+                input_ids = tokenizer(
+                    batch,
+                    max_length=tokenizer.model_max_length,
+                    padding="max_length",
+                    truncation=True,
+                    return_tensors="pt",
+                ).input_ids
+                with torch.no_grad():
+                    prompt_embeds = text_encoder(input_ids.to(accelerator.device), return_dict=False)[0]
+                prompt_embeds = prompt_embeds.float().cpu().numpy()
+                if store is None:
+                    store = np.lib.format.open_memmap(
+                        path + ".tmp", mode="w+", dtype=np.float16, shape=(len(captions),) + prompt_embeds.shape[1:]
+                    )
+                store[start : start + len(batch)] = prompt_embeds
+            store.flush()
+            del store
+            os.replace(path + ".tmp", path)
+            with open(path + ".json", "w") as f:
+                json.dump(key, f)
+            logger.info(f"Cached text embeddings of {len(captions)} captions in {path}")
+    accelerator.wait_for_everyone()
+    return path
+
+
 def main():
     args = parse_args()
     if args.report_to == "wandb" and args.hub_token is not None:
@@ -636,7 +789,7 @@ def main():
 
     # Preprocessing the datasets.
     # We need to tokenize input captions and transform the images.
-    def tokenize_captions(examples, is_train=True):
+    def select_captions(examples, is_train=True):
         captions = []
         for caption in examples[caption_column]:
             if isinstance(caption, str):
@@ -648,11 +801,43 @@ def main():
                 raise ValueError(
                     f"Caption column `{caption_column}` should contain either strings or lists of strings."
                 )
+        return captions
+
+    def tokenize_captions(examples, is_train=True):
         inputs = tokenizer(
-            captions, max_length=tokenizer.model_max_length, padding="max_length", truncation=True, return_tensors="pt"
+            select_captions(examples, is_train),
+            max_length=tokenizer.model_max_length,
+            padding="max_length",
+            truncation=True,
+            return_tensors="pt",
         )
         return inputs.input_ids
 
+    if args.pre_compute_text_embeddings:
+        # Every alternative of a caption list gets its own row, so that a random one can still be picked per step.
+        captions = set()
+        for caption in dataset["train"][caption_column]:
+            captions.update([caption] if isinstance(caption, str) else caption)
+        captions = sorted(captions)
+        text_embeddings_path = cache_text_embeddings(text_encoder, tokenizer, captions, args, accelerator)
+        caption_rows = {caption: row for row, caption in enumerate(captions)}
+        # The text encoder is not needed anymore, validation loads its own.
+        del text_encoder
+        gc.collect()
+        torch.cuda.empty_cache()
+        text_embeddings_store = {}
+
+    def add_text_inputs(examples):
+        if not args.pre_compute_text_embeddings:
+            examples["input_ids"] = tokenize_captions(examples)
+            return
+        if "text_embeddings" not in text_embeddings_store:
+            text_embeddings_store["text_embeddings"] = np.load(text_embeddings_path, mmap_mode="r")
+        text_embeddings = text_embeddings_store["text_embeddings"]
+        examples["prompt_embeds"] = [
+            torch.from_numpy(np.array(text_embeddings[caption_rows[caption]])) for caption in select_captions(examples)
+        ]
+
     # Preprocessing the datasets.
     train_transforms = transforms.Compose(
         [
@@ -672,20 +857,54 @@ def main():
     def preprocess_train(examples):
         images = [image.convert("RGB") for image in examples[image_column]]
         examples["pixel_values"] = [train_transforms(image) for image in images]
-        examples["input_ids"] = tokenize_captions(examples)
+        add_text_inputs(examples)
         return examples
 
     with accelerator.main_process_first():
         if args.max_train_samples is not None:
             dataset["train"] = dataset["train"].shuffle(seed=args.seed).select(range(args.max_train_samples))
-        # Set the training transforms
-        train_dataset = dataset["train"].with_transform(preprocess_train)
+        if not args.cache_latents:
+            # Set the training transforms
+            train_dataset = dataset["train"].with_transform(preprocess_train)
+
+    if args.cache_latents:
+        latents_path = cache_latents(vae, dataset["train"], image_column, args, accelerator, weight_dtype)
+        vae_scaling_factor = vae.config.scaling_factor
+        # Training now reads latents from the store, so neither the VAE nor the images are needed anymore.
+        del vae
+        gc.collect()
+        torch.cuda.empty_cache()
+        # Opened lazily so that every dataloader worker maps the store itself.
+        latents_store = {}
+
+        def preprocess_cached(examples):
+            if "latents" not in latents_store:
+                latents_store["latents"] = np.load(latents_path, mmap_mode="r")
+            latents = latents_store["latents"]
+            # Picking a random variant is the cached equivalent of RandomHorizontalFlip.
+            examples["latent_params"] = [
+                torch.from_numpy(np.array(latents[i, random.randrange(latents.shape[1])]))
+                for i in examples["latents_index"]
+            ]
+            add_text_inputs(examples)
+            return examples
+
+        train_dataset = (
+            dataset["train"]
+            .remove_columns([image_column])
+            .add_column("latents_index", range(len(dataset["train"])))
+            .with_transform(preprocess_cached)
+        )
 
     def collate_fn(examples):
-        pixel_values = torch.stack([example["pixel_values"] for example in examples])
-        pixel_values = pixel_values.to(memory_format=torch.contiguous_format).float()
-        input_ids = torch.stack([example["input_ids"] for example in examples])
-        return {"pixel_values": pixel_values, "input_ids": input_ids}
+        text_key = "prompt_embeds" if args.pre_compute_text_embeddings else "input_ids"
+        batch = {text_key: torch.stack([example[text_key] for example in examples])}
+        if args.cache_latents:
+            batch["latent_params"] = torch.stack([example["latent_params"] for example in examples])
+        else:
+            pixel_values = torch.stack([example["pixel_values"] for example in examples])
+            batch["pixel_values"] = pixel_values.to(memory_format=torch.contiguous_format).float()
+        return batch
 
     # DataLoaders creation:
     train_dataloader = torch.utils.data.DataLoader(
@@ -792,8 +1011,13 @@ def main():
         for step, batch in enumerate(train_dataloader):
             with accelerator.accumulate(unet):
                 # Convert images to latent space
-                latents = vae.encode(batch["pixel_values"].to(dtype=weight_dtype)).latent_dist.sample()
-                latents = latents * vae.config.scaling_factor
+                if args.cache_latents:
+                    latent_params = batch["latent_params"].to(dtype=weight_dtype)
+                    latents = DiagonalGaussianDistribution(latent_params).sample()
+                    latents = latents * vae_scaling_factor
+                else:
+                    latents = vae.encode(batch["pixel_values"].to(dtype=weight_dtype)).latent_dist.sample()
+                    latents = latents * vae.config.scaling_factor
 
                 # Sample noise that we'll add to the latents
                 noise = torch.randn_like(latents)
@@ -813,7 +1037,10 @@ def main():
                 noisy_latents = noise_scheduler.add_noise(latents, noise, timesteps)
 
                 # Get the text embedding for conditioning
-                encoder_hidden_states = text_encoder(batch["input_ids"], return_dict=False)[0]
+                if args.pre_compute_text_embeddings:
+                    encoder_hidden_states = batch["prompt_embeds"].to(dtype=weight_dtype)
+                else:
+                    encoder_hidden_states = text_encoder(batch["input_ids"], return_dict=False)[0]
 
                 # Get the target for loss depending on the prediction type
                 if args.prediction_type is not None:
@@ -0,0 +1,109 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds, from a single UNet step up to a full SD3 run.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0, 120.0, 300.0)
+
+METRIC_NAME = "text2img_stage_seconds"
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class PrometheusSink:
+    """Keeps one histogram per (stage, labels) and renders them as text."""
+
+    enabled = True
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds, labels):
+        key = (stage, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def render(self):
+        lines = [
+            "# HELP {} Time spent in each generation stage.".format(METRIC_NAME),
+            "# TYPE {} histogram".format(METRIC_NAME),
+        ]
+        with self.lock:
+            for (stage, labels), h in sorted(self.histograms.items()):
+                base = [("stage", stage)] + list(labels)
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),),
+                                        h.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append("{}_bucket{} {}".format(
+                        METRIC_NAME, _labels(base + [("le", le)]), cumulative))
+                lines.append("{}_sum{} {}".format(
+                    METRIC_NAME, _labels(base), h.sum))
+                lines.append("{}_count{} {}".format(
+                    METRIC_NAME, _labels(base), h.count))
+        return "\n".join(lines) + "\n"
+
+
+class NullSink:
+    enabled = False
+
+    def observe(self, stage, seconds, labels):
+        pass
+
+    def render(self):
+        return ""
+
+
+def _labels(pairs):
+    escaped = ('{}="{}"'.format(k, str(v).replace("\\", "\\\\")
+                                .replace('"', '\\"').replace("\n", "\\n"))
+               for k, v in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+
+sink = PrometheusSink()
+
+
+def set_sink(new_sink):
+    global sink
+    sink = new_sink
+
+
+def enabled():
+    return sink.enabled
+
+
+def observe(stage, seconds, **labels):
+    sink.observe(stage, seconds, labels)
+
+
+@contextmanager
+def timer(stage, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start, **labels)
+
+
+def render():
+    return sink.render()
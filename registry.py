@@ -0,0 +1,162 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+class ModelRegistry:
+    """Serves several model_ids from one process.
+
+    Pipelines are loaded on first request. The most recently used ones stay
+    on the accelerator, colder ones are moved to CPU RAM and the coldest are
+    dropped, so that each tier stays within its model count and byte budget.
+    Models with work in flight are never moved: a request for a model that
+    doesn't fit on the accelerator waits until a resident one goes idle.
+    """
+
+    def __init__(self, default_model_id, loader=None, device="cuda",
+                 max_gpu_models=1, max_cpu_models=2,
+                 gpu_budget_bytes=None, cpu_budget_bytes=None,
+                 max_batch_size=4):
+        self.default_model_id = default_model_id
+        self.loader = loader or self._load_text2img
+        self.device = device
+        self.max_gpu_models = max_gpu_models
+        self.max_cpu_models = max_cpu_models
+        self.gpu_budget_bytes = gpu_budget_bytes
+        self.cpu_budget_bytes = cpu_budget_bytes
+        self.max_batch_size = max_batch_size
+        # model_id -> generator, least recently used first
+        self.models = OrderedDict()
+        # model_id -> "gpu" or "cpu"
+        self.placement = {}
+        # model_id -> bytes, once the model has been resident
+        self.sizes = {}
+        # Notified whenever a model runs out of work. The notification is
+        # best effort (see _idle), so waiters also poll every poll_interval
+        # seconds.
+        self.cond = threading.Condition()
+        self.poll_interval = 0.1
+
+    def _load_text2img(self, model_id):
+        if os.environ.get("TEXT2IMG_STUB"):
+            import jobs
+            return jobs.StubGenerator(max_batch_size=self.max_batch_size)
+        import text2img
+        return text2img.Text2Img(model_id, max_batch_size=self.max_batch_size,
+                                 device=self.device)
+
+    def get(self, model_id=None):
+        with self.cond:
+            return self._get(model_id or self.default_model_id)
+
+    def submit(self, prompt, cfg_scale=7.0, height=None, width=None,
+               negative_prompt="", num_inference_steps=None, seed=None,
+               progress=None, cancel=None, model_id=None):
+        with self.cond:
+            model = self._get(model_id or self.default_model_id)
+            # Submitted under the lock, so the model is busy before another
+            # request could offload it.
+            return model.submit(
+                prompt, cfg_scale, height, width, negative_prompt,
+                num_inference_steps, seed, progress, cancel)
+
+    def resident(self):
+        with self.cond:
+            return dict(self.placement)
+
+    def _get(self, model_id):
+        while self.placement.get(model_id) != "gpu":
+            # Make room first. A pipeline's size is only known once it has
+            # been resident, so a first load only counts against the limit
+            # on the number of models.
+            if not self._fits(model_id, 1, self.sizes.get(model_id, 0)):
+                self.cond.wait(self.poll_interval)
+                continue
+            model = self.models.get(model_id)
+            if model is None:
+                model = self.loader(model_id)
+                model.add_idle_callback(self._idle)
+                self.models[model_id] = model
+            else:
+                model.to(self.device)
+            self.placement[model_id] = "gpu"
+        model = self.models[model_id]
+        self.models.move_to_end(model_id)
+        self.sizes[model_id] = model.memory_bytes()
+        while not self._fits(model_id):
+            self.cond.wait(self.poll_interval)
+        self._trim_cpu(keep=model_id)
+        return model
+
+    def _idle(self):
+        # Runs on a batcher's thread, which _drop may be joining while it
+        # holds the lock, so this must not block on it. If the lock is
+        # taken, waiters notice on their next poll instead.
+        if self.cond.acquire(blocking=False):
+            try:
+                self.cond.notify_all()
+            finally:
+                self.cond.release()
+
+    def _tier(self, where):
+        return [m for m in self.models if self.placement[m] == where]
+
+    def _bytes(self, model_ids):
+        seen = set()
+        return sum(self.models[m].memory_bytes(seen) for m in model_ids)
+
+    def _over(self, model_ids, max_models, budget, incoming=0,
+              incoming_bytes=0):
+        if len(model_ids) + incoming > max_models:
+            return True
+        return (budget is not None
+                and self._bytes(model_ids) + incoming_bytes > budget)
+
+    def _victim(self, model_ids, keep):
+        for m in model_ids:
+            if m != keep and not self.models[m].busy():
+                return m
+        return None
+
+    def _fits(self, keep, incoming=0, incoming_bytes=0):
+        """Offloads idle models until the accelerator has room for keep.
+
+        Returns False if there is still no room because the other resident
+        models are busy. keep on its own always fits, even if it is over
+        the byte budget by itself.
+        """
+        while True:
+            gpu = self._tier("gpu")
+            if not self._over(gpu, self.max_gpu_models,
+                              self.gpu_budget_bytes, incoming,
+                              incoming_bytes):
+                return True
+            victim = self._victim(gpu, keep)
+            if victim is None:
+                return not any(m != keep for m in gpu)
+            self._offload(victim)
+
+    def _trim_cpu(self, keep):
+        while True:
+            cpu = self._tier("cpu")
+            if not self._over(cpu, self.max_cpu_models,
+                              self.cpu_budget_bytes):
+                break
+            victim = self._victim(cpu, keep)
+            if victim is None:
+                break
+            self._drop(victim)
+
+    def _offload(self, model_id):
+        model = self.models[model_id]
+        if self.max_cpu_models > 0 and model.to("cpu"):
+            self.placement[model_id] = "cpu"
+            print("registry: moved {} to cpu".format(model_id))
+        else:
+            self._drop(model_id)
+
+    def _drop(self, model_id):
+        model = self.models.pop(model_id)
+        del self.placement[model_id]
+        model.unload()
+        print("registry: unloaded {}".format(model_id))
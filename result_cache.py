@@ -0,0 +1,149 @@
+import hashlib
+import io
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+import metrics
+
+
+def request_key(**fields):
+    """Hash of everything that determines a seeded generation."""
+    blob = json.dumps(fields, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+class ResultCache:
+    """Request hash -> PNG bytes, in memory and optionally on disk.
+
+    Both tiers are bounded by size and evict least recently used entries.
+    PNG is lossless, so a hit returns exactly the image that was generated.
+    Stores are encoded on a background thread.
+    """
+
+    def __init__(self, memory_bytes=256 << 20, disk_dir=None,
+                 disk_bytes=10 << 30):
+        self.memory_bytes = memory_bytes
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.disk_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(1)
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self.disk_used = sum(size for _, size, _ in self._disk_files())
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key + ".png")
+
+    def _disk_files(self):
+        for root, _, files in os.walk(self.disk_dir):
+            for name in files:
+                if name.endswith(".png"):
+                    st = os.stat(os.path.join(root, name))
+                    yield os.path.join(root, name), st.st_size, st.st_mtime
+
+    def get(self, key):
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self._open(data)
+
+        data = None
+        if self.disk_dir:
+            path = self._path(key)
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                # mtime is the disk tier's recency.
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+
+        with self.lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, data)
+        return self._open(data)
+
+    def _open(self, data):
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        return image
+
+    def put(self, key, image):
+        self.executor.submit(self._put, key, image)
+
+    def _put(self, key, image):
+        with metrics.timer("image_encode", format="png"):
+            buf = io.BytesIO()
+            image.save(buf, format="PNG")
+        data = buf.getvalue()
+        with self.lock:
+            self._remember(key, data)
+        if self.disk_dir:
+            self._write(key, data)
+
+    def _remember(self, key, data):
+        if key in self.entries or len(data) > self.memory_bytes:
+            return
+        self.entries[key] = data
+        self.bytes += len(data)
+        while self.bytes > self.memory_bytes:
+            _, old = self.entries.popitem(last=False)
+            self.bytes -= len(old)
+
+    def _write(self, key, data):
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self.lock:
+            self.disk_used += len(data)
+            over = self.disk_used > self.disk_bytes
+        if over:
+            self._evict_disk()
+
+    def _evict_disk(self):
+        # Trim to 90% of the budget so eviction doesn't run on every store.
+        files = sorted(self._disk_files(), key=lambda f: f[2])
+        used = sum(size for _, size, _ in files)
+        for path, size, _ in files:
+            if used <= 0.9 * self.disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            used -= size
+        with self.lock:
+            self.disk_used = used
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "disk_bytes": self.disk_used,
+            }
+
+
+cache = ResultCache()
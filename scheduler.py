@@ -0,0 +1,203 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+
+# Priority class -> weight. A flow with twice the weight gets twice the
+# share of the GPU while both have work queued.
+PRIORITY_WEIGHTS = {
+    "interactive": 8.0,
+    "standard": 2.0,
+    "batch": 1.0,
+}
+
+# (model id substring, default steps, default height, default width,
+#  default frames, relative cost per step and megapixel). Checked in order;
+# the defaults mirror what each pipeline does when a request leaves the
+# value unset.
+MODEL_PROFILES = [
+    ("stable-video-diffusion", 25, 576, 1024, 14, 1.0),
+    ("stable-diffusion-3", 150, 1024, 1024, 1, 2.0),
+    ("stable-diffusion-2-1", 50, 768, 768, 1, 1.0),
+    ("", 50, 512, 512, 1, 1.0),
+]
+
+
+def estimate_cost(model_id=None, num_inference_steps=None, height=None,
+                  width=None, num_frames=None):
+    """Relative cost of one job; 1.0 is a 512x512 SD1.5 image at 50 steps."""
+    for name, steps, h, w, frames, factor in MODEL_PROFILES:
+        if name in (model_id or ""):
+            break
+    steps = num_inference_steps or steps
+    pixels = (height or h) * (width or w) / (512 * 512)
+    return steps / 50 * pixels * (num_frames or frames) * factor
+
+
+class FairQueue:
+    """Weighted fair queue of jobs across tenants.
+
+    Every (tenant, priority) pair is a flow with the weight of its priority
+    class. Jobs are served in order of virtual finish time (self-clocked
+    fair queuing): a job finishes cost / weight after the later of the
+    current virtual time and the previous job of its flow. A cheap job
+    therefore overtakes expensive ones queued by other flows, while jobs
+    within a flow keep their order. To bound starvation, a job that has
+    waited longer than max_wait seconds is served next regardless.
+    """
+
+    def __init__(self, weights=None, max_wait=600.0, clock=time.monotonic):
+        self.weights = dict(PRIORITY_WEIGHTS, **(weights or {}))
+        self.max_wait = max_wait
+        self.clock = clock
+        self.virtual_time = 0.0
+        self.last_finish = {}
+        # Entries are [finish, seq, enqueued, cost, item, live] and sit in
+        # both heaps; removed or served entries are skipped lazily.
+        self.by_finish = []
+        self.by_age = []
+        self.entries = {}
+        self.pending_cost = 0.0
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+
+    def __len__(self):
+        with self.cond:
+            return len(self.entries)
+
+    def put(self, item, cost=1.0, tenant="default", priority="standard"):
+        if priority not in self.weights:
+            raise ValueError("unknown priority class {!r}".format(priority))
+        weight = self.weights[priority]
+        with self.cond:
+            flow = (tenant, priority)
+            start = max(self.virtual_time, self.last_finish.get(flow, 0.0))
+            finish = start + cost / weight
+            self.last_finish[flow] = finish
+            entry = [finish, next(self.seq), self.clock(), cost, item, True]
+            heapq.heappush(self.by_finish, entry)
+            heapq.heappush(self.by_age, (entry[2], entry[1], entry))
+            self.entries[id(item)] = entry
+            self.pending_cost += cost
+            self.cond.notify()
+
+    def remove(self, item):
+        """Drops a queued item. Returns False if it isn't queued."""
+        with self.cond:
+            entry = self.entries.pop(id(item), None)
+            if entry is None:
+                return False
+            entry[5] = False
+            self.pending_cost -= entry[3]
+            return True
+
+    def pop(self):
+        """Returns the next item, or None if the queue is empty."""
+        with self.cond:
+            while self.by_age and not self.by_age[0][2][5]:
+                heapq.heappop(self.by_age)
+            if not self.by_age:
+                return None
+            oldest = self.by_age[0][2]
+            if self.clock() - oldest[2] > self.max_wait:
+                entry = oldest
+            else:
+                while not self.by_finish[0][5]:
+                    heapq.heappop(self.by_finish)
+                entry = self.by_finish[0]
+            entry[5] = False
+            del self.entries[id(entry[4])]
+            self.pending_cost -= entry[3]
+            self.virtual_time = max(self.virtual_time, entry[0])
+            return entry[4]
+
+    def get(self, timeout=None):
+        """Blocks until an item is queued and returns it, or None on timeout."""
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.entries, timeout):
+                return None
+            return self.pop()
+
+
+class FifoQueue:
+    """First come, first served; the baseline for the benchmark below."""
+
+    def __init__(self):
+        self.items = []
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, item, cost=1.0, tenant="default", priority="standard"):
+        self.items.append(item)
+
+    def pop(self):
+        return self.items.pop(0) if self.items else None
+
+
+def simulate(queue, arrivals, seconds_per_cost, now):
+    """Runs arrivals through queue on one simulated GPU.
+
+    arrivals is a time-ordered list of (time, kind, cost, tenant, priority);
+    returns {kind: [queue wait, ...]}.
+    """
+    waits = {}
+    pending = list(arrivals)
+    busy_until = 0.0
+    while pending or len(queue):
+        # Everything that arrived before the GPU frees up is queued first.
+        next_free = busy_until
+        if not len(queue):
+            next_free = max(busy_until, pending[0][0])
+        while pending and pending[0][0] <= next_free:
+            job = pending.pop(0)
+            now[0] = job[0]
+            queue.put(job, job[2], job[3], job[4])
+        now[0] = next_free
+        job = queue.pop()
+        waits.setdefault(job[1], []).append(now[0] - job[0])
+        busy_until = now[0] + job[2] * seconds_per_cost
+    return waits
+
+
+def benchmark(num_jobs=2000, seconds_per_cost=1.5, load=0.9, seed=0):
+    rng = random.Random(seed)
+    # kind -> (share of jobs, cost, tenant, priority)
+    mix = {
+        "sd15": (0.70, estimate_cost("runwayml/stable-diffusion-v1-5"),
+                 "web", "interactive"),
+        "sd3": (0.20, estimate_cost("stabilityai/stable-diffusion-3-medium"),
+                "studio", "standard"),
+        "video": (0.10, estimate_cost(
+            "stabilityai/stable-video-diffusion-img2vid", num_frames=24),
+            "bulk", "batch"),
+    }
+    mean_cost = sum(share * cost for share, cost, _, _ in mix.values())
+    rate = load / (mean_cost * seconds_per_cost)
+    arrivals, t = [], 0.0
+    for _ in range(num_jobs):
+        t += rng.expovariate(rate)
+        kind = rng.choices(list(mix), [m[0] for m in mix.values()])[0]
+        _, cost, tenant, priority = mix[kind]
+        arrivals.append((t, kind, cost, tenant, priority))
+
+    now = [0.0]
+    results = {
+        "fifo": simulate(FifoQueue(), arrivals, seconds_per_cost, now),
+        "fair": simulate(FairQueue(clock=lambda: now[0]), arrivals,
+                         seconds_per_cost, now),
+    }
+    print("{} jobs at {:.0%} load".format(num_jobs, load))
+    print("{:<6} {:<6} {:>6} {:>10} {:>10}".format(
+        "queue", "kind", "cost", "mean wait", "p95 wait"))
+    for name, waits in results.items():
+        for kind in mix:
+            w = sorted(waits[kind])
+            print("{:<6} {:<6} {:>6.1f} {:>9.1f}s {:>9.1f}s".format(
+                name, kind, mix[kind][1], sum(w) / len(w),
+                w[int(0.95 * (len(w) - 1))]))
+
+
+if __name__ == "__main__":
+    benchmark()
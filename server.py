@@ -1,11 +1,75 @@
-from flask import Flask,request
+from flask import Flask, Response, request, jsonify, send_file
 from pathlib import Path
 import json
-# import stable_diffusion_2_1
+import os
+import embeddings
+import encoder
+import jobs
+import metrics
+import registry
+import result_cache
+import scheduler
 
 index = Path("webui/index.html").read_text().strip()
 
-# generator = stable_diffusion_2_1.Stable21()
+# The first model is the default; /submit may pick any of the others.
+model_ids = os.environ.get(
+    "MODEL_IDS", "stabilityai/stable-diffusion-2-1").split(",")
+
+# Scheduling priority class of each tenant, e.g. "web=interactive,etl=batch".
+# Tenants identify themselves with the X-Tenant header or a tenant field.
+tenant_priorities = dict(
+    pair.split("=", 1)
+    for pair in os.environ.get("TENANT_PRIORITIES", "").split(",") if pair)
+default_priority = os.environ.get("DEFAULT_PRIORITY", "standard")
+for priority in set(tenant_priorities.values()) | {default_priority}:
+    if priority not in scheduler.PRIORITY_WEIGHTS:
+        raise ValueError(
+            "unknown priority class {!r}, expected one of {}".format(
+                priority, ", ".join(scheduler.PRIORITY_WEIGHTS)))
+
+
+if os.environ.get("RESULT_CACHE_DIR"):
+    result_cache.cache = result_cache.ResultCache(
+        disk_dir=os.environ["RESULT_CACHE_DIR"],
+        disk_bytes=int(os.environ.get("RESULT_CACHE_BYTES", 10 << 30)))
+
+
+def optional(name, cast=int):
+    return cast(os.environ[name]) if os.environ.get(name) else None
+
+
+def load_registry():
+    # GPU_BUDGET_BYTES and CPU_BUDGET_BYTES cap the weights kept on each
+    # tier on top of the model counts.
+    return registry.ModelRegistry(
+        model_ids[0],
+        max_gpu_models=int(os.environ.get("MAX_GPU_MODELS", 1)),
+        max_cpu_models=int(os.environ.get("MAX_CPU_MODELS", 2)),
+        gpu_budget_bytes=optional("GPU_BUDGET_BYTES"),
+        cpu_budget_bytes=optional("CPU_BUDGET_BYTES"))
+
+
+writer = encoder.ImageWriter(
+    os.environ.get("OUTPUT_DIR", "outputs"),
+    format=os.environ.get("IMAGE_FORMAT", "png"),
+    quality=int(os.environ.get("IMAGE_QUALITY", 90)))
+
+
+# Admission limits; past any of them /submit answers 429 with Retry-After.
+# MODEL_MAX_JOBS caps unfinished jobs per model, e.g. "org/sd3=2,org/sd15=8",
+# and MAX_JOBS_PER_MODEL applies to every model not listed.
+model_limits = {
+    model: int(limit) for model, limit in (
+        pair.rsplit("=", 1)
+        for pair in os.environ.get("MODEL_MAX_JOBS", "").split(",") if pair)}
+
+job_queue = jobs.JobQueue(
+    load_registry, writer,
+    max_queued=optional("MAX_QUEUED_JOBS"),
+    max_wait=optional("MAX_QUEUE_WAIT", float),
+    max_per_model=optional("MAX_JOBS_PER_MODEL"),
+    model_limits=model_limits)
 
 app = Flask(__name__)
 
@@ -17,13 +81,95 @@ def hello_world():
 @app.route("/submit", methods=['GET', 'POST'])
 def submit():
     arg = request.form
-    # j=json.load(arg)
-    return "<p>{}</p>".format(arg['text'])
+    cfg_scale = float(arg.get('cfg_scale', 7.0))
+    model_id = arg.get('model', model_ids[0])
+    if model_id not in model_ids:
+        return jsonify({"error": "unknown model", "models": model_ids}), 400
+    seed = int(arg['seed']) if arg.get('seed') else None
+    tenant = request.headers.get('X-Tenant') or arg.get('tenant', 'default')
+    priority = tenant_priorities.get(tenant, default_priority)
+    try:
+        job = job_queue.submit(arg['text'], cfg_scale, model_id,
+                               arg.get('negative', ''), seed, tenant, priority)
+    except jobs.Overloaded as e:
+        return jsonify({"error": str(e), "retry_after": e.retry_after}), 429, {
+            "Retry-After": str(e.retry_after)}
+    return jsonify(job.to_dict()), 202
+
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "unknown job"}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route("/jobs/<job_id>/cancel", methods=['POST'])
+def job_cancel(job_id):
+    job = job_queue.cancel(job_id)
+    if job is None:
+        return jsonify({"error": "unknown job"}), 404
+    return jsonify(job.to_dict())
+
+
+@app.route("/jobs/<job_id>/events")
+def job_events(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "unknown job"}), 404
+
+    def stream():
+        # Server-sent events: progress with step, ETA and periodic latent
+        # previews, then a final status event once the job is finished.
+        event = dict(job.to_dict(), type="status")
+        version = 0
+        while True:
+            if event is None:
+                yield ": keepalive\n\n"
+            else:
+                yield "data: {}\n\n".format(json.dumps(event))
+                if event["type"] == "status" and job.finished:
+                    return
+            event, version = job.wait_event(version, timeout=15)
+
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache"})
+
+
+@app.route("/jobs/<job_id>/image")
+def job_image(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "unknown job"}), 404
+    if job.path is None:
+        return jsonify(job.to_dict()), 409
+    return send_file(os.path.abspath(job.path))
+
 
-@app.route("/image")
-def image():
-    return "<p>Hello, World!</p>"
+@app.route("/metrics")
+def prometheus_metrics():
+    lines = [metrics.render()]
+    stats = embeddings.cache.stats()
+    for name, kind in (("hits", "counter"), ("misses", "counter"),
+                       ("entries", "gauge"), ("bytes", "gauge")):
+        metric = "text2img_embedding_cache_" + name
+        if kind == "counter":
+            metric += "_total"
+        lines.append("# TYPE {} {}\n{} {}\n".format(
+            metric, kind, metric, stats[name]))
+    stats = job_queue.stats()
+    for name, kind in (("queued", "gauge"), ("running", "gauge"),
+                       ("unfinished_cost", "gauge"), ("drain_rate", "gauge"),
+                       ("rejected", "counter")):
+        metric = "text2img_jobs_" + name
+        if kind == "counter":
+            metric += "_total"
+        lines.append("# TYPE {} {}\n{} {}\n".format(
+            metric, kind, metric, stats[name]))
+    return "".join(lines), 200, {
+        "Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
 
 
 if __name__ == '__main__':
-      app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
+      app.run(host='0.0.0.0', port=5000, threaded=True)
@@ -0,0 +1,169 @@
+import heapq
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+
+import batch
+import encoder
+import registry
+
+
+def parse_devices(spec):
+    """Turns "cuda", "cuda:0,cuda:2" or "cpu:4" into a list of devices.
+
+    "cuda" means every visible GPU. "cpu:N" gives N CPU workers, which is
+    how the runner is exercised on machines without GPUs.
+    """
+    if spec == "cuda":
+        import torch
+        return ["cuda:{}".format(i) for i in range(torch.cuda.device_count())]
+    if spec.startswith("cpu:"):
+        return ["cpu"] * int(spec[len("cpu:"):])
+    return spec.split(",")
+
+
+def _worker(device, default_model_id, max_batch_size, window, format,
+            quality, out_dir, tasks, results):
+    generator = registry.ModelRegistry(
+        default_model_id, device=device, max_batch_size=max_batch_size)
+    writer = encoder.ImageWriter(out_dir, format=format, quality=quality)
+    pending = {}
+
+    def finish(futures):
+        for future in futures:
+            index, record, path = pending.pop(future)
+            batch.save_result(
+                writer, future, record, path,
+                lambda result, index=index: results.put((index, result)),
+                device=device)
+
+    # Tasks come from one shared queue, so a worker only takes more work
+    # when it has room for it and a slow device never holds a backlog that
+    # the others could have drained.
+    exhausted = False
+    while not exhausted or pending:
+        while not exhausted and len(pending) < window:
+            chunk = tasks.get()
+            if chunk is None:
+                exhausted = True
+                break
+            for index, record, path in chunk:
+                try:
+                    future = batch.submit(generator, record)
+                except Exception as e:
+                    # A bad record fails on its own instead of taking the
+                    # worker down.
+                    results.put((index, batch.failed(record, e,
+                                                     device=device)))
+                    continue
+                pending[future] = (index, record, path)
+        if pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            finish(done)
+    writer.close()
+    results.put(None)
+
+
+def run(devices, default_model_id, input_path, out_dir, max_batch_size=4,
+        window=None, chunk_size=None, format="png", quality=90):
+    """Data-parallel version of batch.run with one process per device.
+
+    Every process loads its own pipeline. Result lines are written to
+    results.jsonl in input order, regardless of which device finished first.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    window = window or 2 * max_batch_size
+    chunk_size = chunk_size or max_batch_size
+    ctx = multiprocessing.get_context("spawn")
+    tasks = ctx.Queue(maxsize=2 * len(devices))
+    results = ctx.Queue()
+    workers = [ctx.Process(target=_worker,
+                           args=(device, default_model_id, max_batch_size,
+                                 window, format, quality, out_dir, tasks,
+                                 results))
+               for device in devices]
+    for w in workers:
+        w.start()
+
+    counts = {"done": 0, "failed": 0, "skipped": 0}
+    start_time = time.time()
+
+    def feed():
+        index = 0
+        chunk = []
+        extension = encoder.FORMATS[format][1]
+        for record in batch.read_requests(input_path):
+            path = batch.output_path(out_dir, record, extension)
+            if os.path.exists(path):
+                counts["skipped"] += 1
+                continue
+            chunk.append((index, record, path))
+            index += 1
+            if len(chunk) == chunk_size:
+                tasks.put(chunk)
+                chunk = []
+        if chunk:
+            tasks.put(chunk)
+        for _ in workers:
+            tasks.put(None)
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+
+    with open(os.path.join(out_dir, batch.RESULTS_FILE), "a") as out:
+        reorder = []
+        next_index = 0
+        running = len(workers)
+
+        def write(result):
+            counts[result["status"]] += 1
+            out.write(json.dumps(result) + "\n")
+
+        try:
+            while running:
+                try:
+                    item = results.get(timeout=5)
+                except queue.Empty:
+                    dead = [w for w in workers if w.exitcode not in (None, 0)]
+                    if dead:
+                        raise RuntimeError(
+                            "worker exited with code {}".format(
+                                dead[0].exitcode))
+                    continue
+                if item is None:
+                    running -= 1
+                    continue
+                heapq.heappush(reorder, item)
+                while reorder and reorder[0][0] == next_index:
+                    write(heapq.heappop(reorder)[1])
+                    next_index += 1
+                out.flush()
+        finally:
+            if running:
+                # A rerun skips every request whose image exists, so results
+                # held back behind a dead worker's gap are written out of
+                # order rather than lost.
+                for w in workers:
+                    w.terminate()
+                while True:
+                    try:
+                        item = results.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is not None:
+                        heapq.heappush(reorder, item)
+                while reorder:
+                    write(heapq.heappop(reorder)[1])
+                out.flush()
+
+    feeder.join()
+    for w in workers:
+        w.join()
+    print("--- sharded batch on {} devices: {done} done, {failed} failed, "
+          "{skipped} skipped in %s seconds ---".format(len(devices), **counts)
+          % (time.time() - start_time))
+    return counts
@@ -0,0 +1,38 @@
+import json
+import os
+
+import batch
+import registry
+import sharded
+
+
+def write_requests(path, count, bad):
+    with open(path, "w") as f:
+        for i in range(count):
+            f.write(json.dumps({} if i == bad else {"prompt": str(i)}) + "\n")
+
+
+def read_results(out_dir):
+    with open(os.path.join(out_dir, batch.RESULTS_FILE)) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_bad_record_fails_on_its_own(tmp_path, monkeypatch):
+    monkeypatch.setenv("TEXT2IMG_STUB", "1")
+    write_requests(tmp_path / "in.jsonl", 6, bad=2)
+    counts = batch.run(registry.ModelRegistry("a/b"),
+                       str(tmp_path / "in.jsonl"), str(tmp_path / "out"))
+    assert counts == {"done": 5, "failed": 1, "skipped": 0}
+    results = read_results(tmp_path / "out")
+    assert [r["status"] for r in results].count("failed") == 1
+
+
+def test_sharded_bad_record_fails_on_its_own(tmp_path, monkeypatch):
+    monkeypatch.setenv("TEXT2IMG_STUB", "1")
+    write_requests(tmp_path / "in.jsonl", 10, bad=2)
+    counts = sharded.run(["cpu", "cpu"], "a/b", str(tmp_path / "in.jsonl"),
+                         str(tmp_path / "out"))
+    assert counts == {"done": 9, "failed": 1, "skipped": 0}
+    results = read_results(tmp_path / "out")
+    assert [r["id"] for r in results] == [str(i) for i in range(1, 11)]
+    assert results[2]["status"] == "failed"
@@ -0,0 +1,91 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+import torch
+from PIL import Image
+
+import batching
+import embeddings
+import text2img
+
+
+class FakePipe:
+    """Records the requests of every pipeline call instead of denoising."""
+
+    _execution_device = torch.device("cpu")
+
+    def __init__(self):
+        self.calls = []
+
+    def encode_prompt(self, prompt, device, num_images, cfg):
+        return torch.full((1, 2, 4), float(len(prompt))), None
+
+    def __call__(self, guidance_scale, num_inference_steps, generator,
+                 callback_on_step_end, prompt_embeds, **kwargs):
+        self.calls.append((guidance_scale, len(prompt_embeds)))
+        latents = torch.zeros(len(prompt_embeds), 4, 1, 1)
+        for step in range(num_inference_steps):
+            callback_on_step_end(self, step, 0, {"latents": latents})
+        return SimpleNamespace(images=latents)
+
+
+def fake_text2img(max_wait=0.2):
+    s = text2img.Text2Img.__new__(text2img.Text2Img)
+    s.model_id = "fake/fake"
+    s.model_name = "fake"
+    s.lock = threading.Lock()
+    s.embedding_cache = embeddings.EmbeddingCache()
+    s.pipe = FakePipe()
+    s.num_inference_steps = 2
+    s.encoder_name = "text_encoder"
+    s.decode = lambda latents: [Image.new("RGB", (8, 8)) for _ in latents]
+    s.batcher = batching.MicroBatcher(s.run_batch, 4, max_wait)
+    return s
+
+
+def test_coalesces_same_key_up_to_max_batch_size():
+    s = fake_text2img()
+    futures = [s.submit("prompt %d" % i) for i in range(5)]
+    assert all(f.result(timeout=10).size == (8, 8) for f in futures)
+    assert [size for _, size in s.pipe.calls] == [4, 1]
+
+
+def test_different_keys_never_share_a_call():
+    s = fake_text2img()
+    futures = [s.submit("prompt %d" % i, cfg_scale=(7.0, 5.0)[i % 2])
+               for i in range(6)]
+    for f in futures:
+        f.result(timeout=10)
+    assert sorted(s.pipe.calls) == [(5.0, 3), (7.0, 3)]
+
+
+def test_lone_item_runs_after_max_wait():
+    s = fake_text2img(max_wait=0.05)
+    start = time.monotonic()
+    s.submit("prompt").result(timeout=10)
+    assert time.monotonic() - start < 5
+    assert [size for _, size in s.pipe.calls] == [1]
+
+
+def test_exception_results_fail_only_their_item():
+    def run_batch(key, items):
+        return [ValueError(item) if item == "bad" else item for item in items]
+
+    batcher = batching.MicroBatcher(run_batch, max_wait=0.05)
+    good, bad = batcher.submit(0, "good"), batcher.submit(0, "bad")
+    assert good.result(timeout=10) == "good"
+    with pytest.raises(ValueError):
+        bad.result(timeout=10)
+
+
+def test_raising_run_batch_fails_every_item():
+    def run_batch(key, items):
+        raise RuntimeError("out of memory")
+
+    batcher = batching.MicroBatcher(run_batch, max_wait=0.05)
+    futures = [batcher.submit(0, i) for i in range(3)]
+    for f in futures:
+        with pytest.raises(RuntimeError):
+            f.result(timeout=10)
@@ -0,0 +1,28 @@
+import json
+
+import components
+
+
+def component(folder, **config):
+    folder.mkdir()
+    (folder / "diffusion_pytorch_model.bin").write_bytes(b"weights" * 100)
+    (folder / "config.json").write_text(json.dumps(
+        dict({"_class_name": "AutoencoderKL", "latent_channels": 4},
+             **config)))
+    return str(folder)
+
+
+def test_metadata_only_differences_share(tmp_path):
+    a = component(tmp_path / "a", _name_or_path="org/base",
+                  _diffusers_version="0.27.0")
+    b = component(tmp_path / "b", _name_or_path="me/finetune",
+                  _diffusers_version="0.30.2")
+    assert (components.folder_fingerprint(a)
+            == components.folder_fingerprint(b))
+
+
+def test_config_differences_do_not_share(tmp_path):
+    a = component(tmp_path / "a")
+    b = component(tmp_path / "b", latent_channels=16)
+    assert (components.folder_fingerprint(a)
+            != components.folder_fingerprint(b))
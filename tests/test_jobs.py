@@ -0,0 +1,77 @@
+import time
+
+import pytest
+
+import encoder
+import jobs
+import registry
+
+
+def job_queue(tmp_path, delay=0.05, **kwargs):
+    def load_registry():
+        return registry.ModelRegistry(
+            "a", loader=lambda model_id: jobs.StubGenerator(delay=delay),
+            max_gpu_models=2)
+
+    return jobs.JobQueue(load_registry, encoder.ImageWriter(str(tmp_path)),
+                         **kwargs)
+
+
+def wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_max_queued_zero_rejects_with_retry_after(tmp_path):
+    queue = job_queue(tmp_path, max_queued=0)
+    with pytest.raises(jobs.Overloaded) as e:
+        queue.submit("p")
+    assert e.value.retry_after >= 1
+    assert queue.stats()["rejected"] == 1
+    assert queue.stats()["unfinished_cost"] == 0
+
+
+def test_per_model_cap(tmp_path):
+    queue = job_queue(tmp_path, delay=1.0, max_per_model=1)
+    queue.submit("p", model_id="a")
+    with pytest.raises(jobs.Overloaded):
+        queue.submit("p", model_id="a")
+    queue.submit("p", model_id="b")
+
+
+def test_unknown_priority_leaves_no_job(tmp_path):
+    queue = job_queue(tmp_path, max_per_model=1)
+    with pytest.raises(ValueError):
+        queue.submit("p", model_id="a", priority="high")
+    job = queue.submit("p", model_id="a")
+    wait_for(lambda: job.finished)
+    assert job.status == "done"
+
+
+def test_cancel_queued_job_frees_its_accounting(tmp_path):
+    queue = job_queue(tmp_path, delay=1.0, max_inflight=1, max_per_model=2)
+    running = queue.submit("p", model_id="a")
+    wait_for(lambda: running.status == "running")
+    queued = queue.submit("q", model_id="a")
+    queue.cancel(queued.id)
+    assert queued.status == "cancelled"
+    assert queue.stats()["queued"] == 0
+    assert queue.stats()["unfinished_cost"] == running.cost
+    # The cancelled job no longer counts against the model's cap.
+    queue.submit("r", model_id="a")
+
+
+def test_cancel_running_job_frees_its_slot(tmp_path):
+    queue = job_queue(tmp_path, delay=5.0, max_inflight=1)
+    job = queue.submit("p")
+    wait_for(lambda: job.status == "running")
+    queue.cancel(job.id)
+    wait_for(lambda: job.finished)
+    assert job.status == "cancelled"
+    assert job.path is None
+    # With its only slot back, the worker runs the next job.
+    next_job = queue.submit("q")
+    wait_for(lambda: next_job.status == "running")
+    assert queue.stats()["running"] == 1
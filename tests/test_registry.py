@@ -0,0 +1,43 @@
+import threading
+import time
+
+import jobs
+import registry
+
+
+def stub_registry(**kwargs):
+    return registry.ModelRegistry(
+        "a", loader=lambda model_id: jobs.StubGenerator(delay=0.01),
+        **kwargs)
+
+
+def test_alternating_models_stay_within_gpu_limit():
+    models = stub_registry(max_gpu_models=1, max_cpu_models=1)
+    futures = []
+    for i in range(6):
+        futures.append(models.submit("p", model_id="ab"[i % 2]))
+        assert list(models.resident().values()).count("gpu") == 1
+    for f in futures:
+        f.result(timeout=10)
+
+
+def test_dropping_models_does_not_deadlock():
+    models = stub_registry(max_gpu_models=1, max_cpu_models=0)
+    idle = models._idle
+
+    def slow_idle():
+        # Widens the window between a batcher going idle and notifying.
+        time.sleep(0.01)
+        idle()
+
+    models._idle = slow_idle
+
+    def alternate():
+        for i in range(20):
+            models.submit("p", model_id="ab"[i % 2]).result(timeout=10)
+
+    thread = threading.Thread(target=alternate, daemon=True)
+    thread.start()
+    thread.join(timeout=30)
+    assert not thread.is_alive()
+    assert len(models.resident()) == 1
@@ -0,0 +1,67 @@
+import pytest
+
+import scheduler
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def drain(queue):
+    items = []
+    while len(queue):
+        items.append(queue.pop())
+    return items
+
+
+def test_interactive_job_overtakes_queued_batch_jobs():
+    queue = scheduler.FairQueue(clock=Clock())
+    for i in range(5):
+        queue.put("bulk %d" % i, 1.0, "bulk", "batch")
+    queue.put("web", 1.0, "web", "interactive")
+    assert queue.pop() == "web"
+    assert drain(queue) == ["bulk %d" % i for i in range(5)]
+
+
+def test_weights_share_service_between_flows():
+    queue = scheduler.FairQueue(clock=Clock())
+    for i in range(4):
+        queue.put(("standard", i), 1.0, "a", "standard")
+        queue.put(("batch", i), 1.0, "b", "batch")
+    first = [flow for flow, _ in drain(queue)[:6]]
+    # Twice the weight, twice the share.
+    assert first.count("standard") == 4
+    assert first.count("batch") == 2
+
+
+def test_old_job_is_served_first_after_max_wait():
+    clock = Clock()
+    queue = scheduler.FairQueue(max_wait=60.0, clock=clock)
+    queue.put("video", 50.0, "bulk", "batch")
+    clock.now = 1.0
+    queue.put("web", 1.0, "web", "interactive")
+    assert queue.pop() == "web"
+    queue.put("web 2", 1.0, "web", "interactive")
+    clock.now = 62.0
+    assert queue.pop() == "video"
+
+
+def test_removed_job_is_skipped():
+    queue = scheduler.FairQueue(clock=Clock())
+    queue.put("a", 1.0)
+    queue.put("b", 2.0)
+    assert queue.remove("a")
+    assert not queue.remove("a")
+    assert queue.pending_cost == 2.0
+    assert drain(queue) == ["b"]
+
+
+def test_unknown_priority_is_rejected():
+    queue = scheduler.FairQueue()
+    with pytest.raises(ValueError):
+        queue.put("a", 1.0, "t", "high")
+    assert len(queue) == 0
@@ -1,67 +1,340 @@
+import gc
+import os
+import random
+import threading
 import torch
 import time
+import batching
+import components
+import embeddings
+import encoder
+import metrics
+import result_cache
 from accelerate import Accelerator
+from concurrent.futures import CancelledError, Future
 from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler, StableDiffusion3Pipeline
 from pathlib import Path
 
 class Text2Img:
-    def __init__(self, model_id):
+    def __init__(self, model_id, max_batch_size=4, max_wait=0.01,
+                 device="cuda", writer=None):
         self.access_token = Path("/cert/hg_token").read_text().strip()
         self.model_id = model_id
         self.model_name = model_id.split('/')[1]
+        # "cuda" lets SD3 spread over every GPU; an explicit device such as
+        # "cuda:1" or "cpu" keeps the whole pipeline there.
+        self.device = device
+        self.dtype = torch.float32 if device == "cpu" else torch.float16
+        self.lock = threading.Lock()
+        self.embedding_cache = embeddings.cache
+        self.result_cache = result_cache.cache
+        self.writer = writer or encoder.ImageWriter(
+            os.path.join("outputs", self.model_name))
 
         if "stable-diffusion-3" in self.model_name:
             self.stable_diffussion3()
         else:
             self.stable_diffussion()
 
+        self.max_batch_size = max_batch_size
+        self.batcher = batching.MicroBatcher(
+            self.run_batch, max_batch_size, max_wait)
 
     def stable_diffussion(self):
+        # Reuse VAE, text encoder, tokenizer etc. from any resident pipeline
+        # whose weights are byte-identical, instead of loading another copy.
+        pipeline_dir = StableDiffusionPipeline.download(
+            self.model_id, token=self.access_token)
+        fingerprints = components.pool.fingerprints(
+            pipeline_dir, self.dtype)
+        shared = components.pool.lookup(fingerprints)
+        if shared:
+            print("reusing "+", ".join(sorted(shared))+" for "+self.model_name)
         self.pipe = StableDiffusionPipeline.from_pretrained(
-            self.model_id,
-            torch_dtype=torch.float16,
-            token=self.access_token)
+            pipeline_dir,
+            torch_dtype=self.dtype,
+            **shared)
+        components.pool.register(self, fingerprints, self.pipe.components)
         self.pipe.scheduler = DPMSolverMultistepScheduler.from_config(
             self.pipe.scheduler.config)
-        self.pipe = self.pipe.to("cuda")
+        self.pipe = self.pipe.to(self.device)
         self.num_inference_steps = 50
+        self.encoder_name = "text_encoder"
 
     def stable_diffussion3(self):
-        num_gpus = torch.cuda.device_count()
-        print(f"Number of GPUs available: {num_gpus}")
-
-        # Initialize the accelerator
-        accelerator = Accelerator()
+        device_map = {}
+        if self.device == "cuda":
+            num_gpus = torch.cuda.device_count()
+            print(f"Number of GPUs available: {num_gpus}")
+            device_map = {"device_map": "balanced"}
 
         self.pipe = StableDiffusion3Pipeline.from_pretrained(
                 self.model_id,
-                torch_dtype=torch.float16,
+                torch_dtype=self.dtype,
                 token=self.access_token,
-                device_map="balanced",
+                **device_map,
                 )
 
         self.pipe.scheduler = DPMSolverMultistepScheduler.from_config(
             self.pipe.scheduler.config)
         
-        self.pipe = accelerator.prepare(self.pipe)
+        if device_map:
+            # Initialize the accelerator
+            accelerator = Accelerator()
+            self.pipe = accelerator.prepare(self.pipe)
+        else:
+            self.pipe = self.pipe.to(self.device)
         self.num_inference_steps = 150
+        self.encoder_name = "clip_l+clip_g+t5"
 
 
     def generate(self, prompt):
         return self.generate_cfg(prompt=prompt, cfg_scale=7.0)
 
     def generate_cfg(self, prompt, cfg_scale):
-        start_time = time.time()
-        image = self.pipe(prompt,
-                          guidance_scale=cfg_scale,
-                          num_inference_steps=self.num_inference_steps,
-                          ).images[0]
-        print("--- "+self.model_name+": %s seconds ---" %
-              (time.time() - start_time))
-
-        image.save(self.model_name+".png")
+        image = self.submit(prompt, cfg_scale).result()
+        self.writer.submit(image).add_done_callback(
+            lambda f: print("saved "+f.result()))
         return image
 
+    def submit(self, prompt, cfg_scale=7.0, height=None, width=None,
+               negative_prompt="", num_inference_steps=None, seed=None,
+               progress=None, cancel=None):
+        num_inference_steps = num_inference_steps or self.num_inference_steps
+        # Only seeded requests are deterministic, so only they are cached.
+        cache_key = None
+        if seed is not None:
+            cache_key = self.request_key(prompt, negative_prompt, cfg_scale,
+                                         num_inference_steps, height, width,
+                                         seed)
+            image = self.result_cache.get(cache_key)
+            if image is not None:
+                image.info.update(cache_hit=True, seed=seed)
+                future = Future()
+                future.set_result(image)
+                return future
+        else:
+            seed = random.randrange(2**63)
+
+        # Prompts only share a pipeline call when everything but the text
+        # and seed matches.
+        key = (cfg_scale, num_inference_steps, height, width)
+        future = self.batcher.submit(
+            key,
+            batching.Request(prompt, negative_prompt, seed, progress, cancel),
+            cancel)
+        if cache_key is not None:
+            future.add_done_callback(
+                lambda f: f.cancelled() or f.exception() is not None
+                or self.result_cache.put(cache_key, f.result()))
+        return future
+
+    def request_key(self, prompt, negative_prompt, cfg_scale,
+                    num_inference_steps, height, width, seed):
+        return result_cache.request_key(
+            model_id=self.model_id,
+            scheduler=dict(self.pipe.scheduler.config),
+            prompt=embeddings.normalize(prompt),
+            negative_prompt=embeddings.normalize(negative_prompt),
+            guidance_scale=cfg_scale,
+            num_inference_steps=num_inference_steps,
+            height=height,
+            width=width,
+            seed=seed,
+            loras=self.active_adapters(),
+        )
+
+    def active_adapters(self):
+        try:
+            return sorted(self.pipe.get_active_adapters())
+        except (AttributeError, ValueError):
+            # No LoRA support loaded, so there can't be any adapters.
+            return []
+
+    def encode(self, text):
+        return self.embedding_cache.get_or_compute(
+            self.model_id, self.encoder_name, text, self._encode)
+
+    def _encode(self, text):
+        device = self.pipe._execution_device
+        if self.encoder_name == "text_encoder":
+            prompt_embeds, _ = self.pipe.encode_prompt(
+                text, device, 1, False)
+            embeds = (prompt_embeds,)
+        else:
+            prompt_embeds, _, pooled_prompt_embeds, _ = (
+                self.pipe.encode_prompt(text, None, None, device=device,
+                                        do_classifier_free_guidance=False))
+            embeds = (prompt_embeds, pooled_prompt_embeds)
+        # Cached in pinned CPU memory: the registry's GPU budget doesn't
+        # account for the cache, and it outlives offloaded pipelines.
+        # embed_batch copies them back per batch.
+        embeds = tuple(e.cpu() for e in embeds)
+        if torch.cuda.is_available():
+            embeds = tuple(e.pin_memory() for e in embeds)
+        return embeds
+
+    def embed_batch(self, items):
+        # The prompt and negative prompt are encoded independently, so each
+        # side can be served from the cache on its own.
+        device = self.pipe._execution_device
+        cond = [self.encode(item.prompt) for item in items]
+        uncond = [self.encode(item.negative_prompt) for item in items]
+
+        def cat(embeds, i):
+            return torch.cat([e[i].to(device, non_blocking=True)
+                              for e in embeds])
+
+        kwargs = {
+            "prompt_embeds": cat(cond, 0),
+            "negative_prompt_embeds": cat(uncond, 0),
+        }
+        if self.encoder_name != "text_encoder":
+            kwargs["pooled_prompt_embeds"] = cat(cond, 1)
+            kwargs["negative_pooled_prompt_embeds"] = cat(uncond, 1)
+        return kwargs
+
+    def run_batch(self, key, items):
+        cfg_scale, num_inference_steps, height, width = key
+        start_time = time.time()
+        with self.lock, torch.inference_mode():
+            with metrics.timer("text_encode", model=self.model_name):
+                embeds = self.embed_batch(items)
+            # One CPU generator per request keeps each image reproducible
+            # from its seed, whatever it was batched with and on any device.
+            generators = [torch.Generator("cpu").manual_seed(item.seed)
+                          for item in items]
+            latents = self.pipe(guidance_scale=cfg_scale,
+                                num_inference_steps=num_inference_steps,
+                                height=height,
+                                width=width,
+                                generator=generators,
+                                output_type="latent",
+                                callback_on_step_end=self.step_callback(
+                                    items, num_inference_steps),
+                                **embeds,
+                                ).images
+            if all(self.cancelled(item) for item in items):
+                print("--- "+self.model_name+": batch of %d cancelled ---" %
+                      len(items))
+                return [CancelledError() for item in items]
+            images = self.decode(latents)
+        for image, item in zip(images, items):
+            image.info.update(cache_hit=False, seed=item.seed)
+        print("--- "+self.model_name+": %s seconds, batch of %d ---" %
+              (time.time() - start_time, len(items)))
+        return images
+
+    def sync(self):
+        # CUDA kernels run asynchronously; without this, stage timings would
+        # only measure how long it took to queue them.
+        if metrics.enabled() and torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    def cancelled(self, item):
+        return item.cancel is not None and item.cancel.cancelled
+
+    def step_callback(self, items, num_inference_steps):
+        start = time.perf_counter()
+        last = [start]
+
+        def callback(pipe, step, timestep, callback_kwargs):
+            self.sync()
+            now = time.perf_counter()
+            metrics.observe("denoise_step", now - last[0],
+                            model=self.model_name)
+            last[0] = now
+
+            done = step + 1
+            eta = (now - start) / done * (num_inference_steps - done)
+            latents = callback_kwargs["latents"]
+            for i, item in enumerate(items):
+                if item.progress is not None and not self.cancelled(item):
+                    item.progress(done, num_inference_steps, eta, latents[i])
+
+            # Rows can't be dropped from a running batch without rebuilding
+            # the sampler state, so a batch only stops early once every
+            # request in it is cancelled. The pipeline then skips its
+            # remaining steps.
+            if all(self.cancelled(item) for item in items):
+                pipe._interrupt = True
+            return callback_kwargs
+
+        return callback
+
+    def decode(self, latents):
+        # Done here rather than inside the pipeline so VAE decode, safety
+        # check and postprocessing can be timed separately.
+        vae = self.pipe.vae
+        with metrics.timer("vae_decode", model=self.model_name):
+            latents = latents / vae.config.scaling_factor
+            if self.encoder_name != "text_encoder":
+                latents = latents + vae.config.shift_factor
+            image = vae.decode(latents.to(vae.device, vae.dtype),
+                               return_dict=False)[0]
+            self.sync()
+
+        do_denormalize = None
+        if getattr(self.pipe, "safety_checker", None) is not None:
+            with metrics.timer("safety_check", model=self.model_name):
+                image, has_nsfw = self.pipe.run_safety_checker(
+                    image, image.device, image.dtype)
+                do_denormalize = [not nsfw for nsfw in has_nsfw]
+
+        with metrics.timer("postprocess", model=self.model_name):
+            return self.pipe.image_processor.postprocess(
+                image, output_type="pil", do_denormalize=do_denormalize)
+
+    def to(self, device):
+        # A pipeline split across GPUs with device_map can't be moved as a
+        # whole; the caller has to unload it instead.
+        if getattr(self.pipe, "hf_device_map", None):
+            return False
+        with self.lock:
+            for module in self.modules():
+                # A component shared with a pipeline that is still on the
+                # accelerator stays there when this one is offloaded.
+                if device == "cpu" and any(
+                        user is not self and user.device != "cpu"
+                        for user in components.pool.users(module)):
+                    continue
+                module.to(device)
+            self.device = device
+        return True
+
+    def modules(self):
+        return [m for m in self.pipe.components.values()
+                if isinstance(m, torch.nn.Module)]
+
+    def memory_bytes(self, seen=None):
+        # Modules already in seen are not counted again, so callers can sum
+        # several pipelines that share components.
+        if seen is None:
+            seen = set()
+        total = 0
+        for module in self.modules():
+            if id(module) in seen:
+                continue
+            seen.add(id(module))
+            for t in list(module.parameters()) + list(module.buffers()):
+                total += t.numel() * t.element_size()
+        return total
+
+    def busy(self):
+        return self.batcher.busy()
+
+    def add_idle_callback(self, callback):
+        self.batcher.add_idle_callback(callback)
+
+    def unload(self):
+        self.batcher.close()
+        with self.lock:
+            del self.pipe
+        components.pool.release(self)
+        self.embedding_cache.drop(self.model_id)
+        gc.collect()
+        torch.cuda.empty_cache()
+
 
 def run_once(model_id):
     s = Text2Img(model_id)
@@ -75,3 +348,50 @@ def run(model_id):
     while True:
         prompt = input(s.model_name+"> ")
         s.generate(prompt)
+
+
+def main():
+    import argparse
+    import batch
+    import registry
+
+    parser = argparse.ArgumentParser(prog="text2img")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="interactive prompt loop")
+    run_parser.add_argument("--model", default="stabilityai/stable-diffusion-2-1")
+
+    batch_parser = subparsers.add_parser(
+        "batch", help="generate every request in a JSONL file")
+    batch_parser.add_argument("--input", required=True)
+    batch_parser.add_argument("--out", required=True)
+    batch_parser.add_argument("--model", default="stabilityai/stable-diffusion-2-1",
+                              help="model for records without a \"model\" field")
+    batch_parser.add_argument("--max-batch-size", type=int, default=4)
+    batch_parser.add_argument("--window", type=int, default=64,
+                              help="maximum number of requests in flight")
+    batch_parser.add_argument("--format", default="png",
+                              choices=sorted(encoder.FORMATS))
+    batch_parser.add_argument("--quality", type=int, default=90,
+                              help="quality for webp and jpeg output")
+    batch_parser.add_argument("--devices",
+                              help="run one worker process per device, e.g. "
+                                   "\"cuda\", \"cuda:0,cuda:1\" or \"cpu:4\"")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args.model)
+    elif args.devices:
+        import sharded
+        sharded.run(sharded.parse_devices(args.devices), args.model,
+                    args.input, args.out, args.max_batch_size,
+                    format=args.format, quality=args.quality)
+    else:
+        models = registry.ModelRegistry(
+            args.model, max_batch_size=args.max_batch_size)
+        batch.run(models, args.input, args.out, args.window,
+                  format=args.format, quality=args.quality)
+
+
+if __name__ == "__main__":
+    main()